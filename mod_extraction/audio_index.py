@@ -0,0 +1,257 @@
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+import torch as tr
+import torchaudio
+from torch import Tensor as T
+from tqdm import tqdm
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(level=os.environ.get('LOGLEVEL', 'INFO'))
+
+INDEX_FILE_NAME = ".audio_index.json"
+ENERGY_INDEX_FILE_PREFIX = ".energy_index_"
+DEFAULT_NUM_WORKERS = int(os.environ.get("AUDIO_INDEX_NUM_WORKERS", os.cpu_count() or 1))
+
+
+class AudioFileInfo(NamedTuple):
+    num_frames: int
+    sample_rate: int
+    num_channels: int
+    mtime: float
+    size: int
+
+
+# In-memory cache shared by all datasets in a process, keyed by absolute file path
+_file_infos: Dict[str, AudioFileInfo] = {}
+# (mtime, size, envelope) keyed by (absolute file path, frame size)
+_energy_envelopes: Dict[Tuple[str, int], Tuple[float, int, T]] = {}
+# Per-file suitability stats keyed by (absolute file path, mtime, size, frame size, check params)
+_suitability_stats: Dict[Tuple[Any, ...], Dict[str, float]] = {}
+
+
+def read_audio_file_info(file_path: str) -> AudioFileInfo:
+    stat = os.stat(file_path)
+    info = torchaudio.info(file_path)
+    return AudioFileInfo(info.num_frames, info.sample_rate, info.num_channels, stat.st_mtime, stat.st_size)
+
+
+def get_audio_file_info(file_path: str) -> AudioFileInfo:
+    abs_path = os.path.abspath(file_path)
+    file_info = _file_infos.get(abs_path)
+    if file_info is None:
+        file_info = read_audio_file_info(file_path)
+        _file_infos[abs_path] = file_info
+    return file_info
+
+
+def load_audio_index(input_dir: str, file_paths: List[str], should_save: bool = True) -> Dict[str, AudioFileInfo]:
+    # Entries are reused from the on-disk index when the mtime and size of the file are unchanged
+    index_path = os.path.join(input_dir, INDEX_FILE_NAME)
+    disk_index = {}
+    if os.path.isfile(index_path):
+        try:
+            with open(index_path, "r") as f:
+                disk_index = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning(f"Could not read audio index {index_path}, rebuilding it: {e}")
+
+    file_infos = {}
+    new_disk_index = {}
+    n_updated = 0
+    for file_path in file_paths:
+        abs_path = os.path.abspath(file_path)
+        rel_path = os.path.relpath(abs_path, os.path.abspath(input_dir))
+        stat = os.stat(abs_path)
+        file_info = _file_infos.get(abs_path)
+        if file_info is None or file_info.mtime != stat.st_mtime or file_info.size != stat.st_size:
+            entry = disk_index.get(rel_path)
+            if entry is not None and entry[3] == stat.st_mtime and entry[4] == stat.st_size:
+                file_info = AudioFileInfo(*entry)
+            else:
+                file_info = read_audio_file_info(abs_path)
+                n_updated += 1
+            _file_infos[abs_path] = file_info
+        file_infos[file_path] = file_info
+        new_disk_index[rel_path] = list(file_info)
+
+    # Entries of other existing files (e.g. a different ext) are kept, entries of deleted files are dropped
+    for rel_path, entry in disk_index.items():
+        if rel_path not in new_disk_index and os.path.isfile(os.path.join(input_dir, rel_path)):
+            new_disk_index[rel_path] = entry
+    n_removed = len(disk_index) - len([p for p in disk_index if p in new_disk_index])
+
+    log.info(f"Audio index for {input_dir}: {len(file_paths) - n_updated} cached, {n_updated} read, "
+             f"{n_removed} removed")
+    if should_save and (n_updated > 0 or n_removed > 0 or not os.path.isfile(index_path)):
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(new_disk_index, f)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            log.warning(f"Could not save audio index {index_path}: {e}")
+    return file_infos
+
+
+def calc_energy_envelope(file_path: str, frame_size: int) -> T:
+    # Mean energy of every complete frame of every channel, trailing samples that don't fill a frame are dropped
+    audio, _ = torchaudio.load(file_path)
+    n_frames = audio.size(-1) // frame_size
+    energy = audio[:, :n_frames * frame_size] ** 2
+    return energy.view(audio.size(0), n_frames, frame_size).mean(dim=-1)
+
+
+def load_energy_envelopes(input_dir: str,
+                          file_paths: List[str],
+                          frame_size: int,
+                          should_save: bool = True,
+                          num_workers: int = DEFAULT_NUM_WORKERS) -> Dict[str, T]:
+    # Same invalidation scheme as the metadata index, one cache file per directory and frame size
+    index_path = os.path.join(input_dir, f"{ENERGY_INDEX_FILE_PREFIX}{frame_size}.pt")
+    disk_index = {}
+    if os.path.isfile(index_path):
+        try:
+            disk_index = tr.load(index_path)
+        except Exception as e:
+            log.warning(f"Could not read energy index {index_path}, rebuilding it: {e}")
+
+    entries = {}
+    stale_paths = []
+    for file_path in file_paths:
+        abs_path = os.path.abspath(file_path)
+        rel_path = os.path.relpath(abs_path, os.path.abspath(input_dir))
+        stat = os.stat(abs_path)
+        entry = _energy_envelopes.get((abs_path, frame_size))
+        if entry is None or entry[0] != stat.st_mtime or entry[1] != stat.st_size:
+            entry = disk_index.get(rel_path)
+        if entry is None or entry[0] != stat.st_mtime or entry[1] != stat.st_size:
+            stale_paths.append(file_path)
+            entry = (stat.st_mtime, stat.st_size, None)
+        entries[file_path] = entry
+
+    n_updated = len(stale_paths)
+    if n_updated > 0:
+        stale_frame_sizes = [frame_size] * n_updated
+        if num_workers > 1 and n_updated > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                stale_envelopes = list(tqdm(executor.map(calc_energy_envelope,
+                                                         stale_paths,
+                                                         stale_frame_sizes,
+                                                         chunksize=max(1, n_updated // (4 * num_workers))),
+                                            total=n_updated))
+        else:
+            stale_envelopes = [calc_energy_envelope(p, frame_size) for p in tqdm(stale_paths)]
+        for file_path, envelope in zip(stale_paths, stale_envelopes):
+            mtime, size, _ = entries[file_path]
+            entries[file_path] = (mtime, size, envelope)
+
+    envelopes = {}
+    new_disk_index = {}
+    for file_path, entry in entries.items():
+        abs_path = os.path.abspath(file_path)
+        _energy_envelopes[(abs_path, frame_size)] = entry
+        envelopes[file_path] = entry[2]
+        new_disk_index[os.path.relpath(abs_path, os.path.abspath(input_dir))] = entry
+
+    for rel_path, entry in disk_index.items():
+        if rel_path not in new_disk_index and os.path.isfile(os.path.join(input_dir, rel_path)):
+            new_disk_index[rel_path] = entry
+    n_removed = len(disk_index) - len([p for p in disk_index if p in new_disk_index])
+
+    log.info(f"Energy index for {input_dir}: {len(file_paths) - n_updated} cached, {n_updated} computed, "
+             f"{n_removed} removed")
+    if should_save and (n_updated > 0 or n_removed > 0 or not os.path.isfile(index_path)):
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        try:
+            tr.save(new_disk_index, tmp_path)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            log.warning(f"Could not save energy index {index_path}: {e}")
+    return envelopes
+
+
+def calc_valid_start_frames(envelope: T,
+                            frame_size: int,
+                            file_n_samples: int,
+                            n_samples: int,
+                            window_size: int,
+                            hop_len: int,
+                            threshold_energy: float,
+                            end_buffer_n_samples: int = 0) -> T:
+    # Returns the start frames s for which chunks starting anywhere in [s * frame_size, (s + 1) * frame_size) (and not
+    # after the last possible start offset) are guaranteed to pass the windowed silence check. The energy of a window
+    # is lower bounded by the summed energy of the frames lying completely inside it for every offset in the frame.
+    max_start_idx = file_n_samples - n_samples - end_buffer_n_samples
+    if max_start_idx < 0:
+        return tr.zeros((0,), dtype=tr.long)
+    n_starts = (max_start_idx // frame_size) + 1
+    n_windows = ((n_samples - window_size) // hop_len) + 1
+    cum_energy = tr.cumsum(envelope.double() * frame_size, dim=-1)
+    cum_energy = tr.cat([tr.zeros_like(cum_energy[:, :1]), cum_energy], dim=-1)
+    # Small relative margin to absorb float differences with the float32 silence check
+    min_energy = threshold_energy * window_size * (1.0 + 1e-4)
+    # One 1D pass over the envelope per window position, so memory only grows with the length of the file
+    is_valid = tr.ones((n_starts,), dtype=tr.bool)
+    for window_idx in range(n_windows):
+        window_start_idx = window_idx * hop_len
+        lo = (window_start_idx + (2 * frame_size) - 2) // frame_size
+        hi = (window_start_idx + window_size) // frame_size
+        lo_energy = cum_energy[:, hi:hi + n_starts] - cum_energy[:, lo:lo + n_starts]
+        is_valid &= (lo_energy >= min_energy).all(dim=0)
+    return tr.nonzero(is_valid, as_tuple=True)[0]
+
+
+def calc_suitability_stats(valid_start_frames: T,
+                           frame_size: int,
+                           file_n_samples: int,
+                           n_samples: int,
+                           end_buffer_n_samples: int = 0) -> Dict[str, float]:
+    n_start_frames = max(0, ((file_n_samples - n_samples - end_buffer_n_samples) // frame_size) + 1)
+    n_valid_start_frames = len(valid_start_frames)
+    return {
+        "num_frames": file_n_samples,
+        "n_start_frames": n_start_frames,
+        "n_valid_start_frames": n_valid_start_frames,
+        "valid_fraction": n_valid_start_frames / n_start_frames if n_start_frames > 0 else 0.0,
+        "is_suitable": n_valid_start_frames > 0,
+    }
+
+
+def get_suitability_stats(input_dir: str,
+                          file_paths: List[str],
+                          frame_size: int,
+                          n_samples: int,
+                          window_size: int,
+                          hop_len: int,
+                          threshold_energy: float,
+                          end_buffer_n_samples: int = 0) -> Dict[str, Dict[str, float]]:
+    # Cached per file, so multiple copies of a dataset over the same directory only pay for the check once
+    check_params = (frame_size, n_samples, window_size, hop_len, threshold_energy, end_buffer_n_samples)
+    keys = {}
+    for file_path in file_paths:
+        file_info = get_audio_file_info(file_path)
+        keys[file_path] = (os.path.abspath(file_path), file_info.mtime, file_info.size) + check_params
+    unchecked_paths = [p for p in file_paths if keys[p] not in _suitability_stats]
+    if unchecked_paths:
+        envelopes = load_energy_envelopes(input_dir, unchecked_paths, frame_size)
+        for file_path in unchecked_paths:
+            num_frames = get_audio_file_info(file_path).num_frames
+            valid_start_frames = calc_valid_start_frames(envelopes[file_path],
+                                                         frame_size,
+                                                         num_frames,
+                                                         n_samples,
+                                                         window_size,
+                                                         hop_len,
+                                                         threshold_energy,
+                                                         end_buffer_n_samples)
+            _suitability_stats[keys[file_path]] = calc_suitability_stats(valid_start_frames,
+                                                                         frame_size,
+                                                                         num_frames,
+                                                                         n_samples,
+                                                                         end_buffer_n_samples)
+    return {p: _suitability_stats[keys[p]] for p in file_paths}
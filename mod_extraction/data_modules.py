@@ -3,13 +3,16 @@ import os
 from typing import Dict, Any, Optional, List
 
 import pytorch_lightning as pl
+import torch as tr
 from torch import Tensor as T
 from torch.utils.data import DataLoader
 
-from mod_extraction import util
 from mod_extraction.datasets import PedalboardPhaserDataset, RandomAudioChunkAndModSigDataset, RandomAudioChunkDataset, \
-    RandomAudioChunkDryWetDataset, InterwovenDataset, PreprocessedDataset, RandomPreprocessedDataset
-from mod_extraction.fx import MonoFlangerChorusModule
+    RandomAudioChunkDryWetDataset, InterwovenDataset, PreprocessedDataset, RandomPreprocessedDataset, \
+    ShardedPreprocessedDataset, RandomShardedPreprocessedDataset
+from mod_extraction.fx import FXRenderStage
+from mod_extraction.fx_schema import collate_fn
+from mod_extraction.modulations import make_mod_sig_from_config_batched
 from mod_extraction.util import linear_interpolate_last_dim
 
 logging.basicConfig()
@@ -71,6 +74,7 @@ class InterwovenDataModule(pl.LightningDataModule):
             shuffle=True,
             num_workers=self.num_workers,
             drop_last=True,
+            collate_fn=collate_fn,
         )
 
     def val_dataloader(self) -> DataLoader:
@@ -80,6 +84,7 @@ class InterwovenDataModule(pl.LightningDataModule):
             shuffle=False,
             num_workers=self.num_workers,
             drop_last=True,
+            collate_fn=collate_fn,
         )
 
 
@@ -100,7 +105,10 @@ class RandomAudioChunkDataModule(pl.LightningDataModule):
                  check_dataset: bool = True,
                  end_buffer_n_samples: int = 0,
                  should_peak_norm: bool = False,
-                 peak_norm_db: float = -1.0) -> None:
+                 peak_norm_db: float = -1.0,
+                 use_energy_map: bool = False,
+                 energy_frame_size: int = 512,
+                 use_packed_audio: bool = False) -> None:
         super().__init__()
         self.batch_size = batch_size
         assert os.path.isdir(train_dir)
@@ -120,6 +128,9 @@ class RandomAudioChunkDataModule(pl.LightningDataModule):
         self.end_buffer_n_samples = end_buffer_n_samples
         self.should_peak_norm = should_peak_norm
         self.peak_norm_db = peak_norm_db
+        self.use_energy_map = use_energy_map
+        self.energy_frame_size = energy_frame_size
+        self.use_packed_audio = use_packed_audio
         self.train_dataset = None
         self.val_dataset = None
 
@@ -138,6 +149,9 @@ class RandomAudioChunkDataModule(pl.LightningDataModule):
                 end_buffer_n_samples=self.end_buffer_n_samples,
                 should_peak_norm=self.should_peak_norm,
                 peak_norm_db=self.peak_norm_db,
+                use_energy_map=self.use_energy_map,
+                energy_frame_size=self.energy_frame_size,
+                use_packed_audio=self.use_packed_audio,
             )
         if stage == "validate" or "fit":
             self.val_dataset = RandomAudioChunkDataset(
@@ -153,6 +167,9 @@ class RandomAudioChunkDataModule(pl.LightningDataModule):
                 end_buffer_n_samples=self.end_buffer_n_samples,
                 should_peak_norm=self.should_peak_norm,
                 peak_norm_db=self.peak_norm_db,
+                use_energy_map=self.use_energy_map,
+                energy_frame_size=self.energy_frame_size,
+                use_packed_audio=self.use_packed_audio,
             )
 
     def train_dataloader(self) -> DataLoader:
@@ -162,6 +179,7 @@ class RandomAudioChunkDataModule(pl.LightningDataModule):
             shuffle=True,
             num_workers=self.num_workers,
             drop_last=True,
+            collate_fn=collate_fn,
         )
 
     def val_dataloader(self) -> DataLoader:
@@ -171,6 +189,7 @@ class RandomAudioChunkDataModule(pl.LightningDataModule):
             shuffle=False,
             num_workers=self.num_workers,
             drop_last=True,
+            collate_fn=collate_fn,
         )
 
 
@@ -193,7 +212,10 @@ class RandomAudioChunkDryWetDataModule(RandomAudioChunkDataModule):
                  check_dataset: bool = True,
                  end_buffer_n_samples: int = 0,
                  should_peak_norm: bool = False,
-                 peak_norm_db: float = -1.0) -> None:
+                 peak_norm_db: float = -1.0,
+                 use_energy_map: bool = False,
+                 energy_frame_size: int = 512,
+                 use_packed_audio: bool = False) -> None:
         super().__init__(batch_size,
                          dry_train_dir,
                          dry_val_dir,
@@ -209,7 +231,10 @@ class RandomAudioChunkDryWetDataModule(RandomAudioChunkDataModule):
                          check_dataset,
                          end_buffer_n_samples,
                          should_peak_norm,
-                         peak_norm_db)
+                         peak_norm_db,
+                         use_energy_map,
+                         energy_frame_size,
+                         use_packed_audio)
         self.dry_train_dir = dry_train_dir
         self.dry_val_dir = dry_val_dir
         self.wet_train_dir = wet_train_dir
@@ -231,6 +256,9 @@ class RandomAudioChunkDryWetDataModule(RandomAudioChunkDataModule):
                 end_buffer_n_samples=self.end_buffer_n_samples,
                 should_peak_norm=self.should_peak_norm,
                 peak_norm_db=self.peak_norm_db,
+                use_energy_map=self.use_energy_map,
+                energy_frame_size=self.energy_frame_size,
+                use_packed_audio=self.use_packed_audio,
             )
         if stage == "validate" or "fit":
             self.val_dataset = RandomAudioChunkDryWetDataset(
@@ -247,6 +275,9 @@ class RandomAudioChunkDryWetDataModule(RandomAudioChunkDataModule):
                 end_buffer_n_samples=self.end_buffer_n_samples,
                 should_peak_norm=self.should_peak_norm,
                 peak_norm_db=self.peak_norm_db,
+                use_energy_map=self.use_energy_map,
+                energy_frame_size=self.energy_frame_size,
+                use_packed_audio=self.use_packed_audio,
             )
 
     def on_before_batch_transfer(self,
@@ -257,6 +288,9 @@ class RandomAudioChunkDryWetDataModule(RandomAudioChunkDataModule):
 
 
 class PedalboardPhaserDataModule(RandomAudioChunkDataModule):
+    # Batched mod_sig generation leaves a placeholder mod_sig in each item, only FXRenderDataModule fills it in
+    supports_batched_mod_sig = False
+
     def __init__(self,
                  fx_config: Dict[str, Any],
                  batch_size: int,
@@ -274,7 +308,10 @@ class PedalboardPhaserDataModule(RandomAudioChunkDataModule):
                  check_dataset: bool = True,
                  end_buffer_n_samples: int = 0,
                  should_peak_norm: bool = False,
-                 peak_norm_db: float = -1.0) -> None:
+                 peak_norm_db: float = -1.0,
+                 use_energy_map: bool = False,
+                 energy_frame_size: int = 512,
+                 use_packed_audio: bool = False) -> None:
         super().__init__(batch_size,
                          train_dir,
                          val_dir,
@@ -290,7 +327,12 @@ class PedalboardPhaserDataModule(RandomAudioChunkDataModule):
                          check_dataset,
                          end_buffer_n_samples,
                          should_peak_norm,
-                         peak_norm_db)
+                         peak_norm_db,
+                         use_energy_map,
+                         energy_frame_size,
+                         use_packed_audio)
+        assert self.supports_batched_mod_sig or not fx_config.get("mod_sig", {}).get("is_batched", False), \
+            f"mod_sig.is_batched is only supported by FXRenderDataModule, not {self.__class__.__name__}"
         self.fx_config = fx_config
 
     def setup(self, stage: str) -> None:
@@ -309,6 +351,9 @@ class PedalboardPhaserDataModule(RandomAudioChunkDataModule):
                 end_buffer_n_samples=self.end_buffer_n_samples,
                 should_peak_norm=self.should_peak_norm,
                 peak_norm_db=self.peak_norm_db,
+                use_energy_map=self.use_energy_map,
+                energy_frame_size=self.energy_frame_size,
+                use_packed_audio=self.use_packed_audio,
             )
         if stage == "validate" or "fit":
             self.val_dataset = PedalboardPhaserDataset(
@@ -325,6 +370,9 @@ class PedalboardPhaserDataModule(RandomAudioChunkDataModule):
                 end_buffer_n_samples=self.end_buffer_n_samples,
                 should_peak_norm=self.should_peak_norm,
                 peak_norm_db=self.peak_norm_db,
+                use_energy_map=self.use_energy_map,
+                energy_frame_size=self.energy_frame_size,
+                use_packed_audio=self.use_packed_audio,
             )
 
 
@@ -348,6 +396,9 @@ class RandomAudioChunkAndModSigDataModule(PedalboardPhaserDataModule):
                 end_buffer_n_samples=self.end_buffer_n_samples,
                 should_peak_norm=self.should_peak_norm,
                 peak_norm_db=self.peak_norm_db,
+                use_energy_map=self.use_energy_map,
+                energy_frame_size=self.energy_frame_size,
+                use_packed_audio=self.use_packed_audio,
             )
         if stage == "validate" or "fit":
             self.val_dataset = RandomAudioChunkAndModSigDataset(
@@ -364,6 +415,9 @@ class RandomAudioChunkAndModSigDataModule(PedalboardPhaserDataModule):
                 end_buffer_n_samples=self.end_buffer_n_samples,
                 should_peak_norm=self.should_peak_norm,
                 peak_norm_db=self.peak_norm_db,
+                use_energy_map=self.use_energy_map,
+                energy_frame_size=self.energy_frame_size,
+                use_packed_audio=self.use_packed_audio,
             )
 
     def on_before_batch_transfer(self, batch: (T, T), dataloader_idx: int) -> (T, T, T, Dict[str, T]):
@@ -371,92 +425,58 @@ class RandomAudioChunkAndModSigDataModule(PedalboardPhaserDataModule):
         return None, dry, mod_sig, fx_params
 
 
-class FlangerCPUDataModule(PedalboardPhaserDataModule):
-    def __init__(self, *args, **kwargs) -> None:
-        super().__init__(*args, **kwargs)
-        self.flanger = None
+class FXRenderDataModule(RandomAudioChunkAndModSigDataModule):
+    # Workers only load dry audio and mod_sig, the effect is rendered for the entire batch at once
+    supports_batched_mod_sig = True
 
-    def setup(self, stage: str) -> None:
-        self.flanger = MonoFlangerChorusModule(batch_size=self.batch_size,
-                                               n_ch=1,
-                                               n_samples=self.n_samples,
-                                               sr=self.sr,
-                                               max_min_delay_ms=self.fx_config["flanger"]["max_min_delay_ms"],
-                                               max_lfo_delay_ms=self.fx_config["flanger"]["max_lfo_delay_ms"])
-        if stage == "fit":
-            self.train_dataset = RandomAudioChunkAndModSigDataset(
-                self.fx_config,
-                self.train_dir,
-                n_samples=self.n_samples,
-                sr=self.sr,
-                ext=self.ext,
-                num_examples_per_epoch=self.train_num_examples_per_epoch,
-                silence_fraction_allowed=self.silence_fraction_allowed,
-                silence_threshold_energy=self.silence_threshold_energy,
-                n_retries=self.n_retries,
-                check_dataset=self.check_dataset,
-                end_buffer_n_samples=self.end_buffer_n_samples,
-                should_peak_norm=self.should_peak_norm,
-                peak_norm_db=self.peak_norm_db,
-            )
-        if stage == "validate" or "fit":
-            self.val_dataset = RandomAudioChunkAndModSigDataset(
-                self.fx_config,
-                self.val_dir,
-                n_samples=self.n_samples,
-                sr=self.sr,
-                ext=self.ext,
-                num_examples_per_epoch=self.val_num_examples_per_epoch,
-                silence_fraction_allowed=self.silence_fraction_allowed,
-                silence_threshold_energy=self.silence_threshold_energy,
-                n_retries=self.n_retries,
-                check_dataset=self.check_dataset,
-                end_buffer_n_samples=self.end_buffer_n_samples,
-                should_peak_norm=self.should_peak_norm,
-                peak_norm_db=self.peak_norm_db,
-            )
+    def __init__(self, effect_name: str, *args, render_on_device: bool = True, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.effect_name = effect_name
+        self.render_on_device = render_on_device
+        self.render_stage = FXRenderStage(effect_name, self.fx_config, self.sr)
+        self.render_device = tr.device("cpu")
 
-    def on_before_batch_transfer(self, batch: (T, T), dataloader_idx: int) -> (T, T, T, Dict[str, T]):
+    def render(self, batch: (T, T, Dict[str, T])) -> (T, T, T, Dict[str, T]):
         dry, mod_sig, fx_params = batch
-        feedback = util.sample_uniform(
-            self.fx_config["flanger"]["feedback"]["min"],
-            self.fx_config["flanger"]["feedback"]["max"],
-            n=self.batch_size,
-        )
-        min_delay_width = util.sample_uniform(
-            self.fx_config["flanger"]["min_delay_width"]["min"],
-            self.fx_config["flanger"]["min_delay_width"]["max"],
-            n=self.batch_size,
-        )
-        width = util.sample_uniform(
-            self.fx_config["flanger"]["width"]["min"],
-            self.fx_config["flanger"]["width"]["max"],
-            n=self.batch_size,
-        )
-        depth = util.sample_uniform(
-            self.fx_config["flanger"]["depth"]["min"],
-            self.fx_config["flanger"]["depth"]["max"],
-            n=self.batch_size,
-        )
-        mix = util.sample_uniform(
-            self.fx_config["flanger"]["mix"]["min"],
-            self.fx_config["flanger"]["mix"]["max"],
-            n=self.batch_size,
-        )
-        fx_params["depth"] = depth
-        fx_params["feedback"] = feedback
-        fx_params["max_lfo_delay_ms"] = self.flanger.max_lfo_delay_ms
-        fx_params["max_min_delay_ms"] = self.flanger.max_min_delay_ms
-        fx_params["min_delay_width"] = min_delay_width
-        fx_params["mix"] = mix
-        fx_params["width"] = width
-
+        # The stage is only moved when the batches arrive on a new device, usually once for the first batch
+        if dry.device != self.render_device:
+            self.render_stage.to(dry.device)
+            self.render_device = dry.device
+        fx_params.update(self.render_stage.sample_params(dry.size(0), dry.device))
+        if self.fx_config["mod_sig"].get("is_batched", False):
+            # TODO(cm): define LFO sampling rate in config
+            mod_sig = make_mod_sig_from_config_batched(self.fx_config["mod_sig"],
+                                                       self.n_samples // 100,
+                                                       self.sr // 100,
+                                                       fx_params["rate_hz"],
+                                                       fx_params["phase"],
+                                                       fx_params["shape"],
+                                                       fx_params["exp"])
         if mod_sig.size(-1) != dry.size(-1):
             mod_sig = linear_interpolate_last_dim(mod_sig, dry.size(-1))
-
-        wet = self.flanger(dry, mod_sig, feedback, min_delay_width, width, depth, mix)
+        wet = self.render_stage(dry, mod_sig, fx_params)
         return dry, wet, mod_sig, fx_params
 
+    def on_before_batch_transfer(self, batch: (T, T, Dict[str, T]), dataloader_idx: int) -> (T, T, T, Dict[str, T]):
+        if self.render_on_device:
+            return batch
+        return self.render(batch)
+
+    def on_after_batch_transfer(self, batch: (T, T, Dict[str, T]), dataloader_idx: int) -> (T, T, T, Dict[str, T]):
+        if self.render_on_device:
+            return self.render(batch)
+        return batch
+
+
+class FlangerCPUDataModule(FXRenderDataModule):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__("flanger", *args, render_on_device=False, **kwargs)
+
+
+class PhaserCPUDataModule(FXRenderDataModule):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__("phaser", *args, render_on_device=False, **kwargs)
+
 
 class PreprocessedDataModule(pl.LightningDataModule):
     def __init__(self,
@@ -467,7 +487,8 @@ class PreprocessedDataModule(pl.LightningDataModule):
                  sr: float,
                  num_workers: int = 0,
                  train_num_examples_per_epoch: Optional[int] = None,  # TODO(cm): fix offline config to remove this
-                 val_num_examples_per_epoch: Optional[int] = None) -> None:
+                 val_num_examples_per_epoch: Optional[int] = None,
+                 is_sharded: bool = False) -> None:
         super().__init__()
         self.batch_size = batch_size
         assert os.path.isdir(train_dir)
@@ -477,12 +498,14 @@ class PreprocessedDataModule(pl.LightningDataModule):
         self.n_samples = n_samples
         self.sr = sr
         self.num_workers = num_workers
+        self.is_sharded = is_sharded
 
     def setup(self, stage: str) -> None:
+        dataset_class = ShardedPreprocessedDataset if self.is_sharded else PreprocessedDataset
         if stage == "fit":
-            self.train_dataset = PreprocessedDataset(self.train_dir, self.n_samples, self.sr)
+            self.train_dataset = dataset_class(self.train_dir, self.n_samples, self.sr)
         if stage == "validate" or "fit":
-            self.val_dataset = PreprocessedDataset(self.val_dir, self.n_samples, self.sr)
+            self.val_dataset = dataset_class(self.val_dir, self.n_samples, self.sr)
 
     def train_dataloader(self) -> DataLoader:
         return DataLoader(
@@ -491,6 +514,7 @@ class PreprocessedDataModule(pl.LightningDataModule):
             shuffle=True,
             num_workers=self.num_workers,
             drop_last=True,
+            collate_fn=collate_fn,
         )
 
     def val_dataloader(self) -> DataLoader:
@@ -500,6 +524,7 @@ class PreprocessedDataModule(pl.LightningDataModule):
             shuffle=False,
             num_workers=self.num_workers,
             drop_last=True,
+            collate_fn=collate_fn,
         )
 
 
@@ -512,19 +537,21 @@ class RandomPreprocessedDataModule(PreprocessedDataModule):
                  val_dir: str,
                  n_samples: int,
                  sr: float,
-                 num_workers: int = 0) -> None:
-        super().__init__(batch_size, train_dir, val_dir, n_samples, sr, num_workers)
+                 num_workers: int = 0,
+                 is_sharded: bool = False) -> None:
+        super().__init__(batch_size, train_dir, val_dir, n_samples, sr, num_workers, is_sharded=is_sharded)
         self.train_num_examples_per_epoch = train_num_examples_per_epoch
         self.val_num_examples_per_epoch = val_num_examples_per_epoch
 
     def setup(self, stage: str) -> None:
+        dataset_class = RandomShardedPreprocessedDataset if self.is_sharded else RandomPreprocessedDataset
         if stage == "fit":
-            self.train_dataset = RandomPreprocessedDataset(self.train_num_examples_per_epoch,
-                                                           self.train_dir,
-                                                           self.n_samples,
-                                                           self.sr)
+            self.train_dataset = dataset_class(self.train_num_examples_per_epoch,
+                                               self.train_dir,
+                                               self.n_samples,
+                                               self.sr)
         if stage == "validate" or "fit":
-            self.val_dataset = RandomPreprocessedDataset(self.val_num_examples_per_epoch,
-                                                         self.val_dir,
-                                                         self.n_samples,
-                                                         self.sr)
+            self.val_dataset = dataset_class(self.val_num_examples_per_epoch,
+                                             self.val_dir,
+                                             self.n_samples,
+                                             self.sr)
@@ -1,6 +1,5 @@
 import logging
 import os
-from collections import defaultdict
 from typing import Dict, Optional, List, Any, Tuple, Type
 
 import pyloudnorm as pyln
@@ -9,10 +8,12 @@ import torchaudio
 from pedalboard import Pedalboard, Phaser
 from torch import Tensor as T
 from torch.utils.data import Dataset
-from tqdm import tqdm
 
-from mod_extraction import fx, util
+from mod_extraction import audio_index, fx, util
+from mod_extraction.fx_schema import make_fx_params
 from mod_extraction.modulations import make_mod_signal, make_quasi_periodic, make_combined_mod_sig
+from mod_extraction.packed_audio import PackedAudio
+from mod_extraction.shards import ShardReader
 
 logging.basicConfig()
 log = logging.getLogger(__name__)
@@ -34,6 +35,10 @@ def get_dataset_class(name: str) -> Type[Dataset]:
         return PreprocessedDataset
     elif name == "random_preproc":
         return RandomPreprocessedDataset
+    elif name == "sharded_preproc":
+        return ShardedPreprocessedDataset
+    elif name == "random_sharded_preproc":
+        return RandomShardedPreprocessedDataset
     else:
         raise ValueError(f"Unknown dataset name: {name}")
 
@@ -99,6 +104,9 @@ class RandomAudioChunkDataset(Dataset):
             end_buffer_n_samples: int = 0,
             should_peak_norm: bool = False,
             peak_norm_db: float = -1.0,
+            use_energy_map: bool = False,
+            energy_frame_size: int = 512,
+            use_packed_audio: bool = False,
     ) -> None:
         super().__init__()
         self.input_dir = input_dir
@@ -115,14 +123,17 @@ class RandomAudioChunkDataset(Dataset):
         self.end_buffer_n_samples = end_buffer_n_samples
         self.should_peak_norm = should_peak_norm
         self.peak_norm_db = peak_norm_db
+        self.use_energy_map = use_energy_map
+        self.energy_frame_size = energy_frame_size
         self.max_n_consecutive_silent_samples = int(silence_fraction_allowed * n_samples)
 
         input_paths = self.get_file_paths(input_dir, ext)
+        file_infos = audio_index.load_audio_index(input_dir, input_paths)
 
         total_n_samples = 0
         filtered_input_paths = []
         for input_path in input_paths:
-            file_info = torchaudio.info(input_path)
+            file_info = file_infos[input_path]
             if file_info.num_frames < n_samples:
                 log.debug(f"Too short, removing: {input_path}")
                 continue
@@ -136,25 +147,78 @@ class RandomAudioChunkDataset(Dataset):
         assert len(filtered_input_paths) > 0
 
         self.input_paths = filtered_input_paths
+        self.use_packed_audio = use_packed_audio
+        self.packed_audios = []
+        if use_packed_audio:
+            packed_audio = PackedAudio(input_dir)
+            packed_audio.check_is_up_to_date(self.input_paths)
+            self.packed_audios.append(packed_audio)
+        self.valid_start_frames = None
+        self.valid_file_indices = None
+        if use_energy_map:
+            self.init_energy_map(input_dir)
+        self.file_stats = None
         if check_dataset:
             assert self.check_dataset_for_suitable_files(n_samples,
                                                          min_suitable_files_fraction,
                                                          end_buffer_n_samples), \
                 "Could not find a suitable non-silent audio chunk in the dataset"
+            self.file_stats = self.get_file_stats(n_samples, end_buffer_n_samples)
+
+    def init_energy_map(self, input_dir: str) -> None:
+        envelopes = audio_index.load_energy_envelopes(input_dir, self.input_paths, self.energy_frame_size)
+        window_size = self.max_n_consecutive_silent_samples
+        valid_start_frames = []
+        for file_path in self.input_paths:
+            start_frames = audio_index.calc_valid_start_frames(
+                envelopes[file_path],
+                self.energy_frame_size,
+                audio_index.get_audio_file_info(file_path).num_frames,
+                self.n_samples,
+                window_size,
+                window_size // 4,
+                self.silence_threshold_energy,
+                self.end_buffer_n_samples,
+            )
+            valid_start_frames.append(start_frames)
+        self.valid_start_frames = valid_start_frames
+        self.valid_file_indices = [idx for idx, f in enumerate(valid_start_frames) if len(f) > 0]
+        log.info(f"Energy map: {sum(len(f) for f in valid_start_frames)} valid chunk start frames in "
+                 f"{len(self.valid_file_indices)} out of {len(self.input_paths)} files")
+        assert self.valid_file_indices, "Could not find a suitable non-silent audio chunk"
+
+    def get_file_stats(self, n_samples: int, end_buffer_n_samples: int = 0) -> Dict[str, Dict[str, float]]:
+        # Per-file suitability stats, taken from the energy map when it was built for the same chunk size and otherwise
+        # from the cached energy envelopes
+        if self.valid_start_frames is not None \
+                and n_samples == self.n_samples and end_buffer_n_samples == self.end_buffer_n_samples:
+            return {
+                p: audio_index.calc_suitability_stats(start_frames,
+                                                      self.energy_frame_size,
+                                                      audio_index.get_audio_file_info(p).num_frames,
+                                                      n_samples,
+                                                      end_buffer_n_samples)
+                for p, start_frames in zip(self.input_paths, self.valid_start_frames)
+            }
+        window_size = self.max_n_consecutive_silent_samples
+        return audio_index.get_suitability_stats(self.input_dir,
+                                                 self.input_paths,
+                                                 self.energy_frame_size,
+                                                 n_samples,
+                                                 window_size,
+                                                 window_size // 4,
+                                                 self.silence_threshold_energy,
+                                                 end_buffer_n_samples)
 
     def check_dataset_for_suitable_files(self,
                                          n_samples: int,
                                          min_suitable_files_fraction: float,
                                          end_buffer_n_samples: int = 0) -> bool:
+        # A file is suitable if its energy envelope guarantees at least one non-silent chunk of n_samples in it
         min_n_suitable_files = int(min_suitable_files_fraction * len(self.input_paths))
         min_n_suitable_files = max(1, min_n_suitable_files)
-        n_suitable_files = 0
-        for file_path in tqdm(self.input_paths):
-            for _ in range(self.n_retries):
-                audio_chunk = self.find_audio_chunk_in_file(file_path, n_samples, end_buffer_n_samples)
-                if audio_chunk is not None:
-                    n_suitable_files += 1
-                    break
+        file_stats = self.get_file_stats(n_samples, end_buffer_n_samples)
+        n_suitable_files = sum(s["is_suitable"] for s in file_stats.values())
         log.info(f"Found {n_suitable_files} suitable files out of {len(self.input_paths)} files "
                  f"({n_suitable_files / len(self.input_paths) * 100:.2f}%)")
         return n_suitable_files >= min_n_suitable_files
@@ -168,25 +232,54 @@ class RandomAudioChunkDataset(Dataset):
         n_silent = (mean_energies < self.silence_threshold_energy).sum().item()
         return n_silent > 0
 
+    def load_audio_chunk(self, file_path: str, frame_offset: int, num_frames: int) -> T:
+        for packed_audio in self.packed_audios:
+            if file_path in packed_audio:
+                return packed_audio.load(file_path, frame_offset, num_frames)
+        audio_chunk, _ = torchaudio.load(
+            file_path,
+            frame_offset=frame_offset,
+            num_frames=num_frames,
+        )
+        return audio_chunk
+
     def find_audio_chunk_in_file(self,
                                  file_path: str,
                                  n_samples: int,
                                  end_buffer_n_samples: int = 0) -> Optional[Tuple[T, int]]:
-        file_n_samples = torchaudio.info(file_path).num_frames
+        file_n_samples = audio_index.get_audio_file_info(file_path).num_frames
         if n_samples > file_n_samples - end_buffer_n_samples:
             return None
         start_idx = util.randint(0, file_n_samples - n_samples - end_buffer_n_samples + 1)
-        audio_chunk, sr = torchaudio.load(
-            file_path,
-            frame_offset=start_idx,
-            num_frames=n_samples,
-        )
+        audio_chunk = self.load_audio_chunk(file_path, start_idx, n_samples)
         if self.check_for_silence(audio_chunk):
             log.debug("Skipping audio chunk because of silence")
             return None
         return audio_chunk, start_idx
 
+    def sample_audio_chunk_from_energy_map(self) -> (T, str, int):
+        # Same distribution as the random probe: a uniformly chosen file, then a uniformly chosen non-silent start
+        # offset in it. Every offset within a valid start frame is non-silent, so the offset is jittered in the frame.
+        file_idx = util.choice(self.valid_file_indices)
+        file_path = self.input_paths[file_idx]
+        start_frames = self.valid_start_frames[file_idx]
+        start_idx = start_frames[util.randint(0, len(start_frames))].item() * self.energy_frame_size
+        file_n_samples = audio_index.get_audio_file_info(file_path).num_frames
+        max_start_idx = file_n_samples - self.n_samples - self.end_buffer_n_samples
+        start_idx += util.randint(0, min(self.energy_frame_size, max_start_idx - start_idx + 1))
+        audio_chunk = self.load_audio_chunk(file_path, start_idx, self.n_samples)
+        return audio_chunk, file_path, start_idx
+
     def search_dataset_for_audio_chunk(self, n_samples: int, end_buffer_n_samples: int = 0) -> (T, str, int, int):
+        # The energy map is only valid for the n_samples and end_buffer_n_samples of the dataset
+        if self.use_energy_map and n_samples == self.n_samples and end_buffer_n_samples == self.end_buffer_n_samples:
+            audio_chunk, file_path, start_idx = self.sample_audio_chunk_from_energy_map()
+            ch_idx = 0
+            if audio_chunk.size(0) > 1:
+                ch_idx = util.randint(0, audio_chunk.size(0))
+                audio_chunk = audio_chunk[ch_idx, :].view(1, -1)
+            return audio_chunk, file_path, ch_idx, start_idx
+
         file_path_pool = list(self.input_paths)
         file_path = util.choice(file_path_pool)
         file_path_pool.remove(file_path)
@@ -258,6 +351,9 @@ class RandomAudioChunkDryWetDataset(RandomAudioChunkDataset):
             end_buffer_n_samples: int = 0,
             should_peak_norm: bool = False,
             peak_norm_db: float = -1.0,
+            use_energy_map: bool = False,
+            energy_frame_size: int = 512,
+            use_packed_audio: bool = False,
     ) -> None:
         super().__init__(dry_dir,
                          n_samples,
@@ -271,11 +367,16 @@ class RandomAudioChunkDryWetDataset(RandomAudioChunkDataset):
                          min_suitable_files_fraction,
                          end_buffer_n_samples,
                          should_peak_norm,
-                         peak_norm_db)
+                         peak_norm_db,
+                         False,  # The energy map is built once the dry files without a wet pair are removed
+                         energy_frame_size,
+                         use_packed_audio)
+        self.use_energy_map = use_energy_map
         self.dry_dir = dry_dir
         self.wet_dir = wet_dir
         self.end_buffer_n_samples = end_buffer_n_samples
         all_wet_paths = self.get_file_paths(wet_dir, ext)
+        audio_index.load_audio_index(wet_dir, all_wet_paths)
         all_wet_names_to_wet_path = {os.path.basename(p): p for p in all_wet_paths}
         dry_paths = []
         wet_paths = []
@@ -284,8 +385,8 @@ class RandomAudioChunkDryWetDataset(RandomAudioChunkDataset):
             name = os.path.basename(dry_p)
             assert name in all_wet_names_to_wet_path, f"Missing wet file: {name}"
             wet_p = all_wet_names_to_wet_path[name]
-            dry_info = torchaudio.info(dry_p)
-            wet_info = torchaudio.info(wet_p)
+            dry_info = audio_index.get_audio_file_info(dry_p)
+            wet_info = audio_index.get_audio_file_info(wet_p)
             if dry_info.sample_rate != wet_info.sample_rate:
                 log.info(f"Different sample rates: {dry_p}, {wet_p}")
                 continue
@@ -307,17 +408,19 @@ class RandomAudioChunkDryWetDataset(RandomAudioChunkDataset):
         self.dry_paths = dry_paths
         self.wet_paths = wet_paths
         self.name_to_wet_path = name_to_wet_path
+        if use_packed_audio:
+            wet_packed_audio = PackedAudio(wet_dir)
+            wet_packed_audio.check_is_up_to_date(wet_paths)
+            self.packed_audios.append(wet_packed_audio)
+        if use_energy_map:
+            self.init_energy_map(dry_dir)
 
     def __getitem__(self, _) -> (T, T):
         dry_chunk, dry_path, ch_idx, start_idx = self.search_dataset_for_audio_chunk(self.n_samples,
                                                                                      self.end_buffer_n_samples)
         dry_name = os.path.basename(dry_path)
         wet_path = self.name_to_wet_path[dry_name]
-        wet_chunk, _ = torchaudio.load(
-            wet_path,
-            frame_offset=start_idx,
-            num_frames=self.n_samples,
-        )
+        wet_chunk = self.load_audio_chunk(wet_path, start_idx, self.n_samples)
         if wet_chunk.size(0) > 1:
             wet_chunk = wet_chunk[ch_idx, :].view(1, -1)
         assert dry_chunk.shape == wet_chunk.shape
@@ -346,6 +449,9 @@ class RandomAudioChunkAndModSigDataset(RandomAudioChunkDataset):
             end_buffer_n_samples: int = 0,
             should_peak_norm: bool = False,
             peak_norm_db: float = -1.0,
+            use_energy_map: bool = False,
+            energy_frame_size: int = 512,
+            use_packed_audio: bool = False,
     ) -> None:
         super().__init__(input_dir,
                          n_samples,
@@ -359,8 +465,12 @@ class RandomAudioChunkAndModSigDataset(RandomAudioChunkDataset):
                          min_suitable_files_fraction,
                          end_buffer_n_samples,
                          should_peak_norm,
-                         peak_norm_db)
+                         peak_norm_db,
+                         use_energy_map,
+                         energy_frame_size,
+                         use_packed_audio)
         self.fx_config = fx_config
+        self.use_wavetable = fx_config.get("mod_sig", {}).get("use_wavetable", False)
 
     def __getitem__(self, _) -> (T, T, Dict[str, T]):
         audio_chunk = super().__getitem__(_)
@@ -372,16 +482,27 @@ class RandomAudioChunkAndModSigDataset(RandomAudioChunkDataset):
         exp = self.fx_config["mod_sig"]["exp"]
 
         # TODO(cm): define LFO sampling rate in config
-        if "combined" in self.fx_config["mod_sig"] and self.fx_config["mod_sig"]["combined"]:
+        if self.fx_config["mod_sig"].get("is_batched", False):
+            # Generated for the entire batch from fx_params, see FXRenderDataModule
+            mod_sig = tr.zeros((0,))
+        elif "combined" in self.fx_config["mod_sig"] and self.fx_config["mod_sig"]["combined"]:
             mod_sig = make_combined_mod_sig(self.n_samples // 100,
                                             self.sr // 100,
                                             rate_hz,
                                             phase,
-                                            self.fx_config["mod_sig"]["shapes"])
+                                            self.fx_config["mod_sig"]["shapes"],
+                                            self.use_wavetable)
         else:
-            mod_sig = make_mod_signal(self.n_samples // 100, self.sr // 100, rate_hz, phase, shape, exp)
-
-        if "quasiperiodic" in self.fx_config["mod_sig"] and self.fx_config["mod_sig"]["quasiperiodic"]:
+            mod_sig = make_mod_signal(self.n_samples // 100,
+                                      self.sr // 100,
+                                      rate_hz,
+                                      phase,
+                                      shape,
+                                      exp,
+                                      self.use_wavetable)
+
+        if mod_sig.size(0) > 0 and "quasiperiodic" in self.fx_config["mod_sig"] \
+                and self.fx_config["mod_sig"]["quasiperiodic"]:
             l_min = self.fx_config["mod_sig"]["l_min"]
             l_max = self.fx_config["mod_sig"]["l_max"]
             r_min = self.fx_config["mod_sig"]["r_min"]
@@ -389,12 +510,7 @@ class RandomAudioChunkAndModSigDataset(RandomAudioChunkDataset):
             lr_split = self.fx_config["mod_sig"]["lr_split"]
             mod_sig = make_quasi_periodic(mod_sig, l_min, l_max, r_min, r_max, lr_split)
 
-        fx_params = {
-            "rate_hz": rate_hz,
-            "phase": phase,
-            "shape": shape,
-            "exp": exp,
-        }
+        fx_params = make_fx_params(rate_hz=rate_hz, phase=phase, shape=shape, exp=exp)
         return audio_chunk, mod_sig, fx_params
 
 
@@ -404,7 +520,7 @@ class PedalboardPhaserDataset(RandomAudioChunkAndModSigDataset):
         assert "pedalboard_phaser" in self.fx_config
         self.max_file_n_samples = 0
         for file_path in self.input_paths:
-            file_n_samples = torchaudio.info(file_path).num_frames
+            file_n_samples = audio_index.get_audio_file_info(file_path).num_frames
             if file_n_samples > self.max_file_n_samples:
                 self.max_file_n_samples = file_n_samples
         log.info(f"max_file_n_samples = {self.max_file_n_samples} ({self.max_file_n_samples / self.sr:.2f} seconds)")
@@ -439,7 +555,12 @@ class PedalboardPhaserDataset(RandomAudioChunkAndModSigDataset):
                                                              self.sr,
                                                              rate_hz,
                                                              self.fx_config["pedalboard_phaser"])
-        proc_mod_sig = make_mod_signal(proc_n_samples, self.sr, rate_hz, tr.pi / 2, "cos")
+        proc_mod_sig = make_mod_signal(proc_n_samples,
+                                       self.sr,
+                                       rate_hz,
+                                       tr.pi / 2,
+                                       "cos",
+                                       use_wavetable=self.use_wavetable)
 
         # TODO(cm): calc phase and add to fx_params
         start_idx = util.randint(0, proc_n_samples - self.n_samples + 1)
@@ -449,7 +570,7 @@ class PedalboardPhaserDataset(RandomAudioChunkAndModSigDataset):
         # TODO(cm): define LFO sampling rate in config
         mod_sig = util.linear_interpolate_last_dim(mod_sig, self.n_samples // 100, align_corners=True)
 
-        fx_params = defaultdict(float, fx_params)  # TODO(cm): fix param inconsistencies between phaser and flanger
+        fx_params = make_fx_params(**fx_params)
         return dry, wet, mod_sig, fx_params
 
     @staticmethod
@@ -496,8 +617,6 @@ class TremoloDataset(RandomAudioChunkAndModSigDataset):
         fx_params["mix"] = mix
         wet = fx.apply_tremolo(dry.unsqueeze(0), mod_sig.unsqueeze(0), mix)
         wet = wet.squeeze(0)
-
-        fx_params = defaultdict(float, fx_params)  # TODO(cm): fix param inconsistencies between phaser and flanger
         return dry, wet, mod_sig, fx_params
 
 
@@ -523,7 +642,7 @@ class PreprocessedDataset(Dataset):
         wet_path = self.wet_paths[idx]
         data = tr.load(pt_path)
         mod_sig = data["mod_sig"]
-        fx_params = data["fx_params"]
+        fx_params = make_fx_params(**data["fx_params"])
         dry, sr = torchaudio.load(dry_path)
         assert sr == self.sr
         assert dry.size(-1) == self.n_samples
@@ -549,3 +668,40 @@ class RandomPreprocessedDataset(PreprocessedDataset):
     def __getitem__(self, idx: int) -> (T, T, T, Dict[str, Any]):
         rand_idx = util.randint(0, len(self.pt_paths))
         return super().__getitem__(rand_idx)
+
+
+class ShardedPreprocessedDataset(Dataset):
+    def __init__(self,
+                 input_dir: str,
+                 n_samples: int,
+                 sr: float) -> None:
+        super().__init__()
+        self.input_dir = input_dir
+        self.n_samples = n_samples
+        self.sr = sr
+        self.reader = ShardReader(input_dir)
+        assert self.reader.sr == sr
+        assert self.reader.n_samples == n_samples
+
+    def __len__(self) -> int:
+        return len(self.reader)
+
+    def __getitem__(self, idx: int) -> (T, T, T, Dict[str, Any]):
+        return self.reader.read(idx)
+
+
+class RandomShardedPreprocessedDataset(ShardedPreprocessedDataset):
+    def __init__(self,
+                 num_examples_per_epoch: int,
+                 input_dir: str,
+                 n_samples: int,
+                 sr: float) -> None:
+        super().__init__(input_dir, n_samples, sr)
+        self.num_examples_per_epoch = num_examples_per_epoch
+
+    def __len__(self) -> int:
+        return self.num_examples_per_epoch
+
+    def __getitem__(self, idx: int) -> (T, T, T, Dict[str, Any]):
+        rand_idx = util.randint(0, len(self.reader))
+        return super().__getitem__(rand_idx)
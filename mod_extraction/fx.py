@@ -1,7 +1,9 @@
 import logging
+import math
 import os
-from typing import Union
+from typing import Any, Dict, List, Optional, Union
 
+import numpy as np
 import torch as tr
 from torch import Tensor as T, nn
 
@@ -9,6 +11,11 @@ logging.basicConfig()
 log = logging.getLogger(__name__)
 log.setLevel(level=os.environ.get('LOGLEVEL', 'INFO'))
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 def apply_tremolo(x: T, mod_sig: T, mix: Union[float, T] = 1.0) -> T:
     assert x.ndim == 3
@@ -17,11 +24,196 @@ def apply_tremolo(x: T, mod_sig: T, mix: Union[float, T] = 1.0) -> T:
     if mod_sig.ndim == 2:
         mod_sig = mod_sig.unsqueeze(1).expand(-1, x.size(1), -1)
     if isinstance(mix, T):
-        assert mix.size(0) == x.size(0)
-    assert 0.0 <= mix <= 1.0
+        assert mix.shape == (x.size(0),)
+        assert 0.0 <= mix.min() and mix.max() <= 1.0
+        mix = mix.view(-1, 1, 1)
+    else:
+        assert 0.0 <= mix <= 1.0
     return ((1.0 - mix) * x) + (mix * mod_sig * x)
 
 
+def _as_batch_param(param: Union[float, T], x: T) -> T:
+    if isinstance(param, T):
+        assert param.shape == (x.size(0),)
+        return param.to(x.dtype).view(-1, 1, 1)
+    return tr.full((x.size(0), 1, 1), param, dtype=x.dtype, device=x.device)
+
+
+def _phaser_loop_kernel(x: T, g_all: T, feedback: T, feedback_clip: float, n_stages: int) -> T:
+    # x and g_all are (batch_size, n_ch, n_samples), feedback is (batch_size, 1)
+    batch_size = x.size(0)
+    n_ch = x.size(1)
+    states = []
+    for _ in range(n_stages):
+        states.append(x.new_zeros((batch_size, n_ch)))
+    prev_out = x.new_zeros((batch_size, n_ch))
+    wet = []
+    for idx in range(x.size(-1)):
+        # Clipping the fed back signal bounds the input of the all-pass chain, so the loop cannot diverge no matter how
+        # fast the cutoff frequencies are modulated
+        stage_in = x[:, :, idx] + (feedback * tr.clip(prev_out, -feedback_clip, feedback_clip))
+        stage_g = g_all[:, :, idx]
+        for stage_idx in range(n_stages):
+            v = (stage_in - states[stage_idx]) * stage_g
+            lp = v + states[stage_idx]
+            states[stage_idx] = lp + v
+            stage_in = (2.0 * lp) - stage_in
+        prev_out = stage_in
+        wet.append(stage_in)
+    return tr.stack(wet, dim=-1)
+
+
+def _phaser_loop_kernel_np(x, g_all, feedback, feedback_clip, n_stages):
+    # Every value is float32 like the buffers, float64 constants would promote the entire recursion
+    batch_size, n_ch, n_samples = x.shape
+    out = np.zeros_like(x)
+    two = np.float32(2.0)
+    for b_idx in numba.prange(batch_size):
+        for ch_idx in range(n_ch):
+            states = np.zeros((n_stages,), dtype=np.float32)
+            prev_out = np.float32(0.0)
+            for idx in range(n_samples):
+                fb_val = min(max(prev_out, -feedback_clip), feedback_clip)
+                stage_in = x[b_idx, ch_idx, idx] + (feedback[b_idx] * fb_val)
+                stage_g = g_all[b_idx, idx]
+                for stage_idx in range(n_stages):
+                    v = (stage_in - states[stage_idx]) * stage_g
+                    lp = v + states[stage_idx]
+                    states[stage_idx] = lp + v
+                    stage_in = (two * lp) - stage_in
+                prev_out = stage_in
+                out[b_idx, ch_idx, idx] = stage_in
+    return out
+
+
+if numba is not None:
+    _phaser_loop_kernel_np = numba.njit(parallel=True, cache=True)(_phaser_loop_kernel_np)
+
+_phaser_loop_kernel_scripted = None
+
+
+def get_phaser_loop_kernel_scripted():
+    global _phaser_loop_kernel_scripted
+    if _phaser_loop_kernel_scripted is None:
+        try:
+            _phaser_loop_kernel_scripted = tr.jit.script(_phaser_loop_kernel)
+        except Exception as e:
+            log.warning(f"Could not script the phaser loop kernel, falling back to pure PyTorch: {e}")
+            _phaser_loop_kernel_scripted = _phaser_loop_kernel
+    return _phaser_loop_kernel_scripted
+
+
+def apply_phaser(x: T,
+                 mod_sig: T,
+                 sr: float,
+                 centre_frequency_hz: Union[float, T] = 1300.0,
+                 depth: Union[float, T] = 0.5,
+                 feedback: Union[float, T] = 0.0,
+                 mix: Union[float, T] = 0.5,
+                 n_stages: int = 6,
+                 min_frequency_hz: float = 20.0,
+                 max_frequency_hz: float = 20000.0,
+                 max_feedback: float = 0.95,
+                 feedback_clip: float = 1.0,
+                 backend: str = "auto") -> T:
+    # Series of first-order TPT all-pass filters with global feedback, modelled on the JUCE phaser that pedalboard
+    # wraps, except that the all-pass cutoff frequencies are driven directly by mod_sig instead of an internal LFO.
+    # The "auto" backend uses numba on the CPU (TorchScript otherwise) and pure PyTorch when gradients are required.
+    assert x.ndim == 3
+    batch_size, n_ch, n_samples = x.shape
+    assert mod_sig.size(0) == batch_size
+    assert mod_sig.size(-1) == n_samples
+    assert n_stages > 0
+    assert 0.0 <= max_feedback < 1.0
+    assert feedback_clip > 0.0
+    assert backend in {"auto", "torch", "torchscript", "numba"}
+    if mod_sig.ndim == 2:
+        mod_sig = mod_sig.unsqueeze(1)
+    max_frequency_hz = min(max_frequency_hz, 0.49 * sr)
+    centre_frequency_hz = tr.clip(_as_batch_param(centre_frequency_hz, x), min_frequency_hz, max_frequency_hz)
+    depth = _as_batch_param(depth, x)
+    feedback = tr.clip(_as_batch_param(feedback, x).view(-1, 1), -max_feedback, max_feedback)
+    mix = _as_batch_param(mix, x)
+
+    # Cutoff frequencies are modulated on a log frequency scale around the centre frequency
+    norm_centre_frequency = tr.log(centre_frequency_hz / min_frequency_hz) / math.log(max_frequency_hz / min_frequency_hz)
+    norm_cutoff = tr.clip(norm_centre_frequency + (0.5 * depth * ((2.0 * mod_sig) - 1.0)), 0.0, 1.0)
+    cutoff_hz = min_frequency_hz * ((max_frequency_hz / min_frequency_hz) ** norm_cutoff)
+    cutoff_hz = tr.clip(cutoff_hz, min_frequency_hz, max_frequency_hz)
+    g = tr.tan(tr.pi * cutoff_hz / sr)
+    g = g / (1.0 + g)  # (batch_size, 1, n_samples)
+
+    if backend == "auto":
+        is_differentiable = tr.is_grad_enabled() and (x.requires_grad or g.requires_grad or feedback.requires_grad)
+        if is_differentiable:
+            backend = "torch"
+        elif numba is not None and x.device.type == "cpu":
+            backend = "numba"
+        else:
+            backend = "torchscript"
+    elif backend == "numba" and numba is None:
+        log.warning("numba is not installed, falling back to TorchScript")
+        backend = "torchscript"
+
+    if backend == "numba":
+        wet = _phaser_loop_kernel_np(x.detach().to(tr.float32).contiguous().cpu().numpy(),
+                                     g.detach().squeeze(1).to(tr.float32).contiguous().cpu().numpy(),
+                                     feedback.detach().view(-1).to(tr.float32).cpu().numpy(),
+                                     np.float32(feedback_clip),
+                                     n_stages)
+        wet = tr.from_numpy(wet).to(device=x.device, dtype=x.dtype)
+    else:
+        loop_kernel = _phaser_loop_kernel
+        if backend == "torchscript":
+            loop_kernel = get_phaser_loop_kernel_scripted()
+        wet = loop_kernel(x, g.expand(-1, n_ch, -1), feedback, feedback_clip, n_stages)
+    return ((1.0 - mix) * x) + (mix * wet)
+
+
+def _delay_loop_kernel(x: T,
+                       delay_buf: T,
+                       out_buf: T,
+                       delay_write_idx_all: List[int],
+                       prev_idx_all: T,
+                       next_idx_all: T,
+                       delay_read_fraction_all: T,
+                       feedback: T,
+                       depth: T) -> T:
+    for idx in range(x.size(-1)):
+        audio_val = x[:, :, idx]
+        prev_idx = prev_idx_all[:, :, idx].unsqueeze(-1)
+        next_idx = next_idx_all[:, :, idx].unsqueeze(-1)
+        delay_read_fraction = delay_read_fraction_all[:, :, idx]
+        delay_write_idx = delay_write_idx_all[idx]
+
+        prev_val = tr.gather(delay_buf, dim=-1, index=prev_idx).squeeze(-1)
+        next_val = tr.gather(delay_buf, dim=-1, index=next_idx).squeeze(-1)
+        interp_val = (delay_read_fraction * next_val) + ((1.0 - delay_read_fraction) * prev_val)
+        delay_buf[:, :, delay_write_idx] = audio_val + (feedback * interp_val)
+        out_buf[:, :, idx] = audio_val + (depth * interp_val)
+    return out_buf
+
+
+def _delay_loop_kernel_np(x, delay_buf, out_buf, delay_write_idx_all, prev_idx_all, next_idx_all,
+                          delay_read_fraction_all, one_minus_delay_read_fraction_all, feedback, depth):
+    batch_size, n_ch, n_samples = x.shape
+    for b_idx in numba.prange(batch_size):
+        for ch_idx in range(n_ch):
+            for idx in range(n_samples):
+                audio_val = x[b_idx, ch_idx, idx]
+                prev_val = delay_buf[b_idx, ch_idx, prev_idx_all[b_idx, ch_idx, idx]]
+                next_val = delay_buf[b_idx, ch_idx, next_idx_all[b_idx, ch_idx, idx]]
+                interp_val = ((delay_read_fraction_all[b_idx, ch_idx, idx] * next_val)
+                              + (one_minus_delay_read_fraction_all[b_idx, ch_idx, idx] * prev_val))
+                delay_buf[b_idx, ch_idx, delay_write_idx_all[idx]] = audio_val + (feedback[b_idx] * interp_val)
+                out_buf[b_idx, ch_idx, idx] = audio_val + (depth[b_idx] * interp_val)
+    return out_buf
+
+
+if numba is not None:
+    _delay_loop_kernel_np = numba.njit(parallel=True, cache=True)(_delay_loop_kernel_np)
+
+
 class MonoFlangerChorusModule(nn.Module):
     def __init__(self,
                  batch_size: int,
@@ -29,19 +221,72 @@ class MonoFlangerChorusModule(nn.Module):
                  n_samples: int,
                  sr: float,
                  max_min_delay_ms: float,
-                 max_lfo_delay_ms: float) -> None:
+                 max_lfo_delay_ms: float,
+                 engine: str = "loop",
+                 backend: str = "torch",
+                 is_streaming: bool = False) -> None:
         super().__init__()
+        assert engine in {"loop", "chunked"}
+        assert backend in {"torch", "torchscript", "numba"}
         self.batch_size = batch_size
         self.n_ch = n_ch
         self.n_samples = n_samples
         self.sr = sr
         self.max_min_delay_ms = max_min_delay_ms
         self.max_lfo_delay_ms = max_lfo_delay_ms
+        self.engine = engine
+        self.is_streaming = is_streaming
+        self.loop_kernel = _delay_loop_kernel
+        if backend == "torchscript":
+            try:
+                self.loop_kernel = tr.jit.script(_delay_loop_kernel)
+            except Exception as e:
+                log.warning(f"Could not script the delay loop kernel, falling back to pure PyTorch: {e}")
+                backend = "torch"
+        elif backend == "numba" and numba is None:
+            log.warning("numba is not installed, falling back to pure PyTorch")
+            backend = "torch"
+        self.backend = backend
         self.max_min_delay_samples = int(((max_min_delay_ms / 1000.0) * sr) + 0.5)
         self.max_lfo_delay_samples = int(((max_lfo_delay_ms / 1000.0) * sr) + 0.5)
         self.max_delay_samples = self.max_min_delay_samples + self.max_lfo_delay_samples
         self.register_buffer("delay_buf", tr.zeros((batch_size, n_ch, self.max_delay_samples)))
         self.register_buffer("out_buf", tr.zeros((batch_size, n_ch, n_samples)))
+        self.delay_write_idx = 0
+
+    def get_buf(self, name: str, batch_size: int, n_ch: int, n_samples: int) -> T:
+        # Buffers only ever grow, smaller shapes reuse the existing storage through views
+        buf = getattr(self, name)
+        if batch_size > buf.size(0) or n_ch > buf.size(1) or n_samples > buf.size(2):
+            log.debug(f"Growing {name} to fit shape ({batch_size}, {n_ch}, {n_samples})")
+            buf = buf.new_zeros((max(batch_size, buf.size(0)), max(n_ch, buf.size(1)), max(n_samples, buf.size(2))))
+            setattr(self, name, buf)
+        return buf[:batch_size, :n_ch, :n_samples]
+
+    def get_delay_buf(self, x: T) -> T:
+        return self.get_buf("delay_buf", x.size(0), x.size(1), self.max_delay_samples)
+
+    def get_out_buf(self, x: T) -> T:
+        return self.get_buf("out_buf", x.size(0), x.size(1), x.size(2))
+
+    def reset_state(self) -> None:
+        self.delay_buf.fill_(0)
+        self.delay_write_idx = 0
+
+    def get_delay_history(self, x: T) -> T:
+        # Returns the contents of delay_buf ordered in time, oldest sample first
+        if not self.is_streaming:
+            return x.new_zeros((x.size(0), x.size(1), self.max_delay_samples))
+        return tr.roll(self.get_delay_buf(x), -self.delay_write_idx, dims=-1)
+
+    def update_delay_buf(self, delay_line: T) -> None:
+        # Writes the tail of a linear (time ordered) delay line back into the circular delay_buf
+        if not self.is_streaming:
+            return
+        n_samples = delay_line.size(-1) - self.max_delay_samples
+        next_delay_write_idx = (self.delay_write_idx + n_samples) % self.max_delay_samples
+        delay_tail = delay_line[:, :, -self.max_delay_samples:]
+        self.get_delay_buf(delay_tail).copy_(tr.roll(delay_tail, next_delay_write_idx, dims=-1))
 
     def check_param(self,
                     param: Union[float, T],
@@ -69,6 +314,190 @@ class MonoFlangerChorusModule(nn.Module):
                 assert param < 1.0
         return param
 
+    @staticmethod
+    def is_zero(param: Union[float, T]) -> bool:
+        if isinstance(param, T):
+            return not param.any().item()
+        return param == 0.0
+
+    def calc_delay_lag(self, delay_write_idx_all: T, delay_idx_all: T) -> T:
+        # Number of samples since delay_buf[delay_idx] was last written, in [1, max_delay_samples]
+        return ((delay_write_idx_all - delay_idx_all - 1) % self.max_delay_samples) + 1
+
+    def calc_delay_time_idx(self, delay_write_idx_all: T, delay_idx_all: T) -> T:
+        # Index into a delay line that is stored linearly in time and left padded with max_delay_samples zeros
+        n_samples = delay_write_idx_all.size(-1)
+        time_idx_all = tr.arange(self.max_delay_samples,
+                                 self.max_delay_samples + n_samples,
+                                 device=delay_write_idx_all.device).view(1, 1, -1)
+        return time_idx_all - self.calc_delay_lag(delay_write_idx_all, delay_idx_all)
+
+    def apply_delay_loop(self,
+                         x: T,
+                         delay_write_idx_all: T,
+                         prev_idx_all: T,
+                         next_idx_all: T,
+                         delay_read_fraction_all: T,
+                         feedback: Union[float, T],
+                         depth: Union[float, T]) -> T:
+        delay_buf = self.get_delay_buf(x)
+        out_buf = self.get_out_buf(x)
+        out_buf.fill_(0)
+        if self.backend == "numba":
+            return self.apply_delay_loop_numba(x,
+                                               delay_write_idx_all,
+                                               prev_idx_all,
+                                               next_idx_all,
+                                               delay_read_fraction_all,
+                                               feedback,
+                                               depth)
+        if not isinstance(feedback, T):
+            feedback = tr.full((x.size(0), 1), feedback, dtype=x.dtype, device=x.device)
+        if not isinstance(depth, T):
+            depth = tr.full((x.size(0), 1), depth, dtype=x.dtype, device=x.device)
+        return self.loop_kernel(x,
+                                delay_buf,
+                                out_buf,
+                                delay_write_idx_all[0, 0, :].tolist(),
+                                prev_idx_all,
+                                next_idx_all,
+                                delay_read_fraction_all,
+                                feedback.to(x.dtype),
+                                depth.to(x.dtype))
+
+    def apply_delay_loop_numba(self,
+                               x: T,
+                               delay_write_idx_all: T,
+                               prev_idx_all: T,
+                               next_idx_all: T,
+                               delay_read_fraction_all: T,
+                               feedback: Union[float, T],
+                               depth: Union[float, T]) -> T:
+        batch_size = x.size(0)
+        if isinstance(feedback, T):
+            feedback = feedback.view(-1).to(x.dtype).cpu().numpy()
+        else:
+            feedback = tr.full((batch_size,), feedback, dtype=x.dtype).numpy()
+        if isinstance(depth, T):
+            depth = depth.view(-1).to(x.dtype).cpu().numpy()
+        else:
+            depth = tr.full((batch_size,), depth, dtype=x.dtype).numpy()
+        # 1.0 - fraction is precomputed in torch so that the kernel only ever works with float32 values
+        one_minus_delay_read_fraction_all = 1.0 - delay_read_fraction_all
+        delay_buf = self.get_delay_buf(x)
+        out_buf = self.get_out_buf(x)
+        delay_buf_np = delay_buf.contiguous().cpu().numpy()
+        out_buf_np = out_buf.contiguous().cpu().numpy()
+        out_buf_np = _delay_loop_kernel_np(x.contiguous().cpu().numpy(),
+                                           delay_buf_np,
+                                           out_buf_np,
+                                           delay_write_idx_all[0, 0, :].contiguous().cpu().numpy(),
+                                           prev_idx_all.contiguous().cpu().numpy(),
+                                           next_idx_all.contiguous().cpu().numpy(),
+                                           delay_read_fraction_all.contiguous().cpu().numpy(),
+                                           one_minus_delay_read_fraction_all.contiguous().cpu().numpy(),
+                                           feedback,
+                                           depth)
+        delay_buf.copy_(tr.from_numpy(delay_buf_np))
+        out_buf.copy_(tr.from_numpy(out_buf_np))
+        return out_buf
+
+    def apply_delay_no_feedback(self,
+                                x: T,
+                                delay_write_idx_all: T,
+                                prev_idx_all: T,
+                                next_idx_all: T,
+                                delay_read_fraction_all: T,
+                                depth: Union[float, T]) -> T:
+        # Without feedback the delay line only ever contains the input signal, so every read can be
+        # gathered directly from the input (preceded by the delay history) instead of stepping through the buffer
+        delay_line = tr.cat([self.get_delay_history(x), x], dim=-1)
+        self.update_delay_buf(delay_line)
+        prev_time_idx_all = self.calc_delay_time_idx(delay_write_idx_all, prev_idx_all)
+        next_time_idx_all = self.calc_delay_time_idx(delay_write_idx_all, next_idx_all)
+        prev_val = tr.gather(delay_line, dim=-1, index=prev_time_idx_all)
+        next_val = tr.gather(delay_line, dim=-1, index=next_time_idx_all)
+        interp_val = (delay_read_fraction_all * next_val) + ((1.0 - delay_read_fraction_all) * prev_val)
+        if isinstance(depth, T):
+            depth = depth.view(-1, 1, 1)
+        return x + (depth * interp_val)
+
+    def apply_delay_chunked(self,
+                            x: T,
+                            delay_write_idx_all: T,
+                            prev_idx_all: T,
+                            next_idx_all: T,
+                            delay_read_fraction_all: T,
+                            feedback: Union[float, T],
+                            depth: Union[float, T]) -> T:
+        # Every read looks at least min_lag samples into the past, so all samples of a block that is not longer
+        # than min_lag only depend on previous blocks and can be computed at once
+        batch_size, n_ch, n_samples = x.shape
+        prev_time_idx_all = self.calc_delay_time_idx(delay_write_idx_all, prev_idx_all)
+        next_time_idx_all = self.calc_delay_time_idx(delay_write_idx_all, next_idx_all)
+        time_idx_all = tr.arange(self.max_delay_samples,
+                                 self.max_delay_samples + n_samples,
+                                 device=x.device).view(1, 1, -1)
+        min_lag = (time_idx_all - tr.maximum(prev_time_idx_all, next_time_idx_all)).min().item()
+        block_n_samples = max(1, int(min_lag))
+        log.debug(f"Using a block size of {block_n_samples} samples")
+        if isinstance(feedback, T):
+            feedback = feedback.view(-1, 1, 1)
+        if isinstance(depth, T):
+            depth = depth.view(-1, 1, 1)
+
+        delay_line = x.new_zeros((batch_size, n_ch, self.max_delay_samples + n_samples))
+        delay_line[:, :, :self.max_delay_samples] = self.get_delay_history(x)
+        out_buf = tr.empty_like(x)
+        for start_idx in range(0, n_samples, block_n_samples):
+            end_idx = min(start_idx + block_n_samples, n_samples)
+            audio_val = x[:, :, start_idx:end_idx]
+            prev_idx = prev_time_idx_all[:, :, start_idx:end_idx]
+            next_idx = next_time_idx_all[:, :, start_idx:end_idx]
+            delay_read_fraction = delay_read_fraction_all[:, :, start_idx:end_idx]
+
+            prev_val = tr.gather(delay_line, dim=-1, index=prev_idx)
+            next_val = tr.gather(delay_line, dim=-1, index=next_idx)
+            interp_val = (delay_read_fraction * next_val) + ((1.0 - delay_read_fraction) * prev_val)
+            write_start_idx = self.max_delay_samples + start_idx
+            write_end_idx = self.max_delay_samples + end_idx
+            delay_line[:, :, write_start_idx:write_end_idx] = audio_val + (feedback * interp_val)
+            out_buf[:, :, start_idx:end_idx] = audio_val + (depth * interp_val)
+
+        self.update_delay_buf(delay_line)
+        return out_buf
+
+    def apply_delay(self,
+                    x: T,
+                    delay_write_idx_all: T,
+                    prev_idx_all: T,
+                    next_idx_all: T,
+                    delay_read_fraction_all: T,
+                    feedback: Union[float, T],
+                    depth: Union[float, T]) -> T:
+        if self.is_zero(feedback):
+            return self.apply_delay_no_feedback(x,
+                                                delay_write_idx_all,
+                                                prev_idx_all,
+                                                next_idx_all,
+                                                delay_read_fraction_all,
+                                                depth)
+        elif self.engine == "chunked":
+            return self.apply_delay_chunked(x,
+                                            delay_write_idx_all,
+                                            prev_idx_all,
+                                            next_idx_all,
+                                            delay_read_fraction_all,
+                                            feedback,
+                                            depth)
+        return self.apply_delay_loop(x,
+                                     delay_write_idx_all,
+                                     prev_idx_all,
+                                     next_idx_all,
+                                     delay_read_fraction_all,
+                                     feedback,
+                                     depth)
+
     def apply_effect(self,
                      x: T,
                      mod_sig: T,
@@ -88,11 +517,12 @@ class MonoFlangerChorusModule(nn.Module):
         width = self.check_param(width, batch_size, out_n_dim=3, can_be_one=True)
         depth = self.check_param(depth, batch_size, out_n_dim=2, can_be_one=True)
         mix = self.check_param(mix, batch_size, out_n_dim=3, can_be_one=True)
+        if not self.is_streaming:
+            self.reset_state()
 
-        self.delay_buf.fill_(0)
-        self.out_buf.fill_(0)
-
-        delay_write_idx_all = tr.arange(0, n_samples) % self.max_delay_samples
+        delay_write_idx_all = tr.arange(self.delay_write_idx,
+                                        self.delay_write_idx + n_samples,
+                                        device=x.device) % self.max_delay_samples
         delay_write_idx_all = delay_write_idx_all.view(1, 1, -1).expand(batch_size, n_ch, -1)
         min_delay_samples = min_delay_width * self.max_min_delay_samples
         delay_samples_all = (self.max_lfo_delay_samples * width * mod_sig) + min_delay_samples
@@ -101,20 +531,36 @@ class MonoFlangerChorusModule(nn.Module):
         prev_idx_all = tr.floor(delay_read_idx_all).to(tr.long)
         next_idx_all = (prev_idx_all + 1) % self.max_delay_samples
 
-        for idx in range(n_samples):
-            audio_val = x[:, :, idx]
-            prev_idx = prev_idx_all[:, :, idx].unsqueeze(-1)
-            next_idx = next_idx_all[:, :, idx].unsqueeze(-1)
-            delay_read_fraction = delay_read_fraction_all[:, :, idx]
-            delay_write_idx = delay_write_idx_all[0, 0, idx]
+        zero_feedback_mask = None
+        if isinstance(feedback, T) and not self.is_streaming:
+            # Items without feedback are split off so that they never go through the recursion. Streaming keeps the
+            # delay state of the entire batch, so it only takes the fast path when no item has feedback.
+            zero_feedback_mask = feedback.view(-1) == 0.0
+            if zero_feedback_mask.all() or not zero_feedback_mask.any():
+                zero_feedback_mask = None
 
-            prev_val = tr.gather(self.delay_buf, dim=-1, index=prev_idx).squeeze(-1)
-            next_val = tr.gather(self.delay_buf, dim=-1, index=next_idx).squeeze(-1)
-            interp_val = (delay_read_fraction * next_val) + ((1.0 - delay_read_fraction) * prev_val)
-            self.delay_buf[:, :, delay_write_idx] = audio_val + (feedback * interp_val)
-            self.out_buf[:, :, idx] = audio_val + (depth * interp_val)
+        if zero_feedback_mask is None:
+            out_buf = self.apply_delay(x,
+                                       delay_write_idx_all,
+                                       prev_idx_all,
+                                       next_idx_all,
+                                       delay_read_fraction_all,
+                                       feedback,
+                                       depth)
+        else:
+            out_buf = tr.empty_like(x)
+            for mask in [zero_feedback_mask, ~zero_feedback_mask]:
+                out_buf[mask] = self.apply_delay(x[mask],
+                                                 delay_write_idx_all[mask],
+                                                 prev_idx_all[mask],
+                                                 next_idx_all[mask],
+                                                 delay_read_fraction_all[mask],
+                                                 feedback[mask],
+                                                 depth[mask] if isinstance(depth, T) else depth)
+
+        self.delay_write_idx = (self.delay_write_idx + n_samples) % self.max_delay_samples
 
-        out_buf = ((1.0 - mix) * x) + (mix * self.out_buf)
+        out_buf = ((1.0 - mix) * x) + (mix * out_buf)
         out_buf = tr.clip(out_buf, -1.0, 1.0)  # TODO(cm): should clip flag
         return out_buf
 
@@ -128,3 +574,74 @@ class MonoFlangerChorusModule(nn.Module):
                 mix: Union[float, T] = 1.0) -> T:
         with tr.no_grad():
             return self.apply_effect(x, mod_sig, feedback, min_delay_width, width, depth, mix)
+
+
+class FXRenderStage(nn.Module):
+    # Batch level effect rendering, runs on whichever device the dry audio and mod_sig are on
+    effect_names = {"tremolo", "flanger", "phaser"}
+    log_uniform_param_names = {"centre_frequency_hz", "rate_hz"}
+
+    def __init__(self, effect_name: str, fx_config: Dict[str, Any], sr: float) -> None:
+        super().__init__()
+        assert effect_name in self.effect_names
+        assert effect_name in fx_config
+        self.effect_name = effect_name
+        self.effect_config = fx_config[effect_name]
+        self.sr = sr
+        self.backend = self.effect_config.get("backend", "auto")
+        self.flanger = None
+        if effect_name == "flanger":
+            # Buffers are grown on demand by the flanger, so the initial shape is arbitrary
+            self.flanger = MonoFlangerChorusModule(batch_size=1,
+                                                   n_ch=1,
+                                                   n_samples=1,
+                                                   sr=sr,
+                                                   max_min_delay_ms=self.effect_config["max_min_delay_ms"],
+                                                   max_lfo_delay_ms=self.effect_config["max_lfo_delay_ms"],
+                                                   engine=self.effect_config.get("engine", "loop"),
+                                                   backend=self.effect_config.get("backend", "torch"))
+
+    def sample_params(self, batch_size: int, device: Optional[tr.device] = None) -> Dict[str, Union[float, T]]:
+        # Every {min, max} entry of the effect config is sampled per batch item, other numeric entries are fixed
+        fx_params = {}
+        for name, val in self.effect_config.items():
+            if isinstance(val, dict) and "min" in val and "max" in val:
+                low, high = val["min"], val["max"]
+                if name in self.log_uniform_param_names and low != high:
+                    assert 0.0 < low < high
+                    u = tr.rand(batch_size, device=device)
+                    fx_params[name] = tr.exp((u * (math.log(high) - math.log(low))) + math.log(low))
+                else:
+                    fx_params[name] = (tr.rand(batch_size, device=device) * (high - low)) + low
+            elif isinstance(val, (int, float)) and not isinstance(val, bool):
+                fx_params[name] = val
+        return fx_params
+
+    def forward(self, dry: T, mod_sig: T, fx_params: Dict[str, Union[float, T]]) -> T:
+        assert dry.ndim == 3
+        assert mod_sig.size(-1) == dry.size(-1)
+        with tr.no_grad():
+            if self.effect_name == "tremolo":
+                wet = apply_tremolo(dry, mod_sig, fx_params["mix"])
+            elif self.effect_name == "flanger":
+                wet = self.flanger(dry,
+                                   mod_sig,
+                                   fx_params["feedback"],
+                                   fx_params["min_delay_width"],
+                                   fx_params["width"],
+                                   fx_params["depth"],
+                                   fx_params["mix"])
+            elif self.effect_name == "phaser":
+                wet = apply_phaser(dry,
+                                   mod_sig,
+                                   self.sr,
+                                   fx_params["centre_frequency_hz"],
+                                   fx_params["depth"],
+                                   fx_params["feedback"],
+                                   fx_params["mix"],
+                                   backend=self.backend)
+            else:
+                raise ValueError(f"Unknown effect: {self.effect_name}")
+        wet = tr.clip(wet, -1.0, 1.0)  # TODO(cm): should clip flag
+        return wet
+
@@ -0,0 +1,65 @@
+import logging
+import os
+from typing import Dict, Any, List, Union
+
+import torch as tr
+from torch import Tensor as T
+from torch.utils.data import default_collate
+
+from mod_extraction.modulations import SHAPES
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(level=os.environ.get('LOGLEVEL', 'INFO'))
+
+# Every fx_params dict has exactly these keys, missing params default to 0.0 and the shape is stored as its index
+# in SHAPES (-1 if there is none)
+FX_PARAMS_SCHEMA = {
+    "rate_hz": tr.float32,
+    "phase": tr.float32,
+    "shape": tr.long,
+    "exp": tr.float32,
+    "depth": tr.float32,
+    "feedback": tr.float32,
+    "mix": tr.float32,
+    "width": tr.float32,
+    "min_delay_width": tr.float32,
+    "min_delay_ms": tr.float32,
+    "max_min_delay_ms": tr.float32,
+    "max_lfo_delay_ms": tr.float32,
+    "centre_frequency_hz": tr.float32,
+}
+NO_SHAPE_CODE = -1
+FX_PARAMS_DEFAULTS = {k: NO_SHAPE_CODE if k == "shape" else 0.0 for k in FX_PARAMS_SCHEMA}
+
+
+def shape_to_code(shape: Union[str, int]) -> int:
+    if isinstance(shape, str):
+        return SHAPES.index(shape)
+    return int(shape)
+
+
+def make_fx_params(**kwargs: Any) -> Dict[str, Union[float, int]]:
+    fx_params = dict(FX_PARAMS_DEFAULTS)
+    for k, v in kwargs.items():
+        assert k in FX_PARAMS_SCHEMA, f"Unknown fx_param: {k}"
+        if isinstance(v, T):
+            v = v.item()
+        if k == "shape":
+            v = shape_to_code(v)
+        fx_params[k] = v
+    return fx_params
+
+
+def collate_fx_params(items: List[Dict[str, Union[float, int]]]) -> Dict[str, T]:
+    # One tensor creation per column instead of default_collate walking every item
+    return {k: tr.tensor([item[k] for item in items], dtype=dtype) for k, dtype in FX_PARAMS_SCHEMA.items()}
+
+
+def collate_fn(batch: List[Any]) -> Any:
+    elem = batch[0]
+    if isinstance(elem, dict):
+        return collate_fx_params(batch)
+    if isinstance(elem, tuple):
+        return tuple(collate_fn(list(items)) for items in zip(*batch))
+    return default_collate(batch)
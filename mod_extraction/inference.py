@@ -0,0 +1,147 @@
+import logging
+import math
+import os
+from typing import Iterator, List, Optional, Tuple
+
+import torch as tr
+import torchaudio
+from torch import Tensor as T
+from torch import nn
+
+from mod_extraction import audio_index
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(level=os.environ.get('LOGLEVEL', 'INFO'))
+
+
+class StreamingLFOExtractor:
+    # Runs a spectral LFO extraction model over arbitrarily long audio in fixed size overlapping chunks and overlap-adds
+    # the windowed mod_sig_hat frames. Only batch_size chunks are in memory at a time, the output is at the frame rate
+    # of the model (sr / hop_len). Models with in_ch == 2 (dry and wet, e.g. the "io" models) take the two signals stacked
+    # along the channel dim in that order, like the LFO model input during training.
+    def __init__(self,
+                 model: nn.Module,
+                 chunk_n_samples: int = 88200,
+                 hop_n_samples: Optional[int] = None,
+                 batch_size: int = 8,
+                 min_window_weight: float = 1e-3) -> None:
+        assert hasattr(model, "hop_len")
+        self.model = model.eval()
+        self.hop_len = model.hop_len
+        self.in_ch = getattr(model, "in_ch", 1)
+        assert self.in_ch in {1, 2}, f"Only mono or dry and wet models are supported, not in_ch = {self.in_ch}"
+        if hop_n_samples is None:
+            hop_n_samples = (chunk_n_samples // 2 // self.hop_len) * self.hop_len
+        # Chunks have to start on frame boundaries so that their frames line up with the frames of the entire signal
+        assert hop_n_samples % self.hop_len == 0
+        assert 0 < hop_n_samples <= chunk_n_samples
+        assert batch_size > 0
+        self.chunk_n_samples = chunk_n_samples
+        self.hop_n_samples = hop_n_samples
+        self.batch_size = batch_size
+        self.chunk_n_frames = chunk_n_samples // self.hop_len + 1
+        # The floor keeps the edges of the signal, which are only covered by one chunk, from dividing by zero
+        self.window = tr.clip(tr.hann_window(self.chunk_n_frames, periodic=False), min=min_window_weight)
+        # Layer norms with ln_mode="fixed" only accept the number of frames the model was built with
+        fixed_ln_n_frames = {m.normalized_shape[-1] for m in model.modules() if isinstance(m, nn.LayerNorm)}
+        assert all(n == self.chunk_n_frames for n in fixed_ln_n_frames), \
+            f"The model has fixed length layer norms for {sorted(fixed_ln_n_frames)} frames, but chunks have " \
+            f"{self.chunk_n_frames} frames. Build the model with ln_mode=\"any\" or change chunk_n_samples."
+
+    def calc_chunk_starts(self, n_samples: int) -> List[int]:
+        n_chunks = max(1, math.ceil(max(0, n_samples - self.chunk_n_samples) / self.hop_n_samples) + 1)
+        return [idx * self.hop_n_samples for idx in range(n_chunks)]
+
+    def run_model(self, x: T) -> T:
+        with tr.no_grad():
+            out = self.model(x)
+        if isinstance(out, tuple):
+            out = out[0]
+        # (batch_size, latent_dim, n_frames)
+        assert out.ndim == 3
+        assert out.size(-1) == self.chunk_n_frames, \
+            f"Expected {self.chunk_n_frames} frames per chunk, but the model returned {out.size(-1)}"
+        return out
+
+    def extract_chunks(self, chunks: Iterator[Tuple[int, T]], n_samples: int) -> T:
+        # chunks yields (start_idx, audio) with audio of shape (n_ch, <= chunk_n_samples)
+        device = next(self.model.parameters()).device
+        window = self.window.to(device)
+        n_frames = n_samples // self.hop_len + 1
+        mod_sig_hat = None
+        weights = tr.zeros((n_frames + self.chunk_n_frames,), device=device)
+        batch = []
+        batch_starts = []
+
+        def process_batch() -> None:
+            nonlocal mod_sig_hat
+            x = tr.stack(batch, dim=0).to(device)
+            out = self.run_model(x)
+            if mod_sig_hat is None:
+                mod_sig_hat = tr.zeros((out.size(1), n_frames + self.chunk_n_frames), device=device)
+            for start_idx, chunk_out in zip(batch_starts, out):
+                start_frame = start_idx // self.hop_len
+                end_frame = start_frame + self.chunk_n_frames
+                mod_sig_hat[:, start_frame:end_frame] += chunk_out * window
+                weights[start_frame:end_frame] += window
+            batch.clear()
+            batch_starts.clear()
+
+        for start_idx, audio in chunks:
+            assert audio.size(0) == self.in_ch, f"Expected {self.in_ch} input channels, but got {audio.size(0)}"
+            if audio.size(-1) < self.chunk_n_samples:
+                audio = tr.nn.functional.pad(audio, (0, self.chunk_n_samples - audio.size(-1)))
+            batch.append(audio)
+            batch_starts.append(start_idx)
+            if len(batch) == self.batch_size:
+                process_batch()
+        if batch:
+            process_batch()
+
+        mod_sig_hat = mod_sig_hat[:, :n_frames] / weights[:n_frames]
+        return mod_sig_hat
+
+    def extract(self, audio: T) -> T:
+        # audio is (in_ch, n_samples), returns (latent_dim, n_samples // hop_len + 1)
+        assert audio.ndim == 2
+        n_samples = audio.size(-1)
+        chunks = ((s, audio[:, s:s + self.chunk_n_samples]) for s in self.calc_chunk_starts(n_samples))
+        return self.extract_chunks(chunks, n_samples)
+
+    def extract_dry_wet(self, dry: T, wet: T) -> T:
+        # dry and wet are (1, n_samples)
+        assert self.in_ch == 2
+        assert dry.shape == wet.shape
+        return self.extract(tr.cat([dry, wet], dim=0))
+
+    def load_chunk(self, file_path: str, start_idx: int, ch_idx: Optional[int] = None) -> T:
+        audio, _ = torchaudio.load(file_path, frame_offset=start_idx, num_frames=self.chunk_n_samples)
+        if ch_idx is not None:
+            audio = audio[ch_idx:ch_idx + 1, :]
+        return audio
+
+    def extract_from_file(self, file_path: str, ch_idx: Optional[int] = None) -> T:
+        # Reads the file chunk by chunk, so memory does not grow with the length of the recording
+        n_samples = audio_index.get_audio_file_info(file_path).num_frames
+
+        def load_chunks() -> Iterator[Tuple[int, T]]:
+            for start_idx in self.calc_chunk_starts(n_samples):
+                yield start_idx, self.load_chunk(file_path, start_idx, ch_idx)
+
+        return self.extract_chunks(load_chunks(), n_samples)
+
+    def extract_from_dry_wet_files(self, dry_path: str, wet_path: str, ch_idx: int = 0) -> T:
+        # Same as extract_from_file, the ch_idx channels of the dry and wet files are stacked for every chunk
+        assert self.in_ch == 2
+        n_samples = audio_index.get_audio_file_info(dry_path).num_frames
+        wet_n_samples = audio_index.get_audio_file_info(wet_path).num_frames
+        assert n_samples == wet_n_samples, f"Dry and wet files have different lengths: {n_samples} != {wet_n_samples}"
+
+        def load_chunks() -> Iterator[Tuple[int, T]]:
+            for start_idx in self.calc_chunk_starts(n_samples):
+                dry = self.load_chunk(dry_path, start_idx, ch_idx)
+                wet = self.load_chunk(wet_path, start_idx, ch_idx)
+                yield start_idx, tr.cat([dry, wet], dim=0)
+
+        return self.extract_chunks(load_chunks(), n_samples)
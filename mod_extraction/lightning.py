@@ -1,7 +1,7 @@
 import logging
 import os
 from contextlib import nullcontext
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 import pytorch_lightning as pl
 import torch as tr
@@ -10,8 +10,8 @@ from torch import nn
 from torch.optim import Optimizer
 
 from mod_extraction.losses import get_loss_func_by_name
-from mod_extraction.models import HiddenStateModel, RandomLFO
-from mod_extraction.modulations import stretch_corners, find_valid_mod_sig_indices
+from mod_extraction.models import BufferedLSTMEffectModel, HiddenStateModel, RandomLFO
+from mod_extraction.modulations import stretch_corners, find_valid_mod_sig_mask
 from mod_extraction.plotting import plot_spectrogram, plot_mod_sig
 from mod_extraction.util import linear_interpolate_last_dim
 
@@ -129,16 +129,14 @@ class LFOExtraction(BaseLightingModule):
 
         loss = self.calc_and_log_losses(mod_sig_hat, mod_sig, prefix)
 
+        # Kept on the device, the callbacks only copy the examples they log to the CPU
         data_dict = {
-            "wet": wet.detach().float().cpu(),
-            "mod_sig": mod_sig.detach().float().cpu(),
-            "mod_sig_hat": mod_sig_hat.detach().float().cpu(),
+            "wet": wet.detach(),
+            "mod_sig": mod_sig.detach(),
+            "mod_sig_hat": mod_sig_hat.detach(),
         }
         if dry is not None:
-            data_dict["dry"] = dry.detach().float().cpu()
-
-        if fx_params is not None:
-            fx_params = {k: v.detach().float().cpu() if isinstance(v, T) else v for k, v in fx_params.items()}
+            data_dict["dry"] = dry.detach()
 
         # Debugging loop
         # if wet.size(0) < 15:
@@ -162,9 +160,8 @@ class LFOExtraction(BaseLightingModule):
                                    is_training: bool) -> (T, Dict[str, T], Dict[str, T]):
         dry, wet, mod_sig, fx_params = batch
         inferred_bs = mod_sig.size(0)
-        assert inferred_bs >= self.sub_batch_size
-        assert inferred_bs % self.sub_batch_size == 0
         losses = []
+        sub_batch_sizes = []
         out_data_dict = None
         out_fx_params = None
         for start_idx in range(0, inferred_bs, self.sub_batch_size):
@@ -174,14 +171,17 @@ class LFOExtraction(BaseLightingModule):
                 sub_dry = dry[start_idx:end_idx, ...]
             sub_wet = wet[start_idx:end_idx, ...]
             sub_mod_sig = mod_sig[start_idx:end_idx, ...]
-            sub_fx_params = {k: v[start_idx:end_idx, ...] for k, v in fx_params.items()}
+            sub_fx_params = {k: v[start_idx:end_idx, ...] if isinstance(v, T) else v for k, v in fx_params.items()}
             sub_batch = (sub_dry, sub_wet, sub_mod_sig, sub_fx_params)
             loss, out_data_dict, out_fx_params = self.common_step(sub_batch, is_training=is_training)
             losses.append(loss)
+            sub_batch_sizes.append(sub_mod_sig.size(0))
         assert losses
         assert out_data_dict is not None
         assert out_fx_params is not None
-        loss = tr.stack(losses, dim=0).mean(dim=0)
+        # The last sub-batch can be smaller than sub_batch_size
+        sub_batch_weights = tr.tensor(sub_batch_sizes, dtype=losses[0].dtype, device=losses[0].device) / inferred_bs
+        loss = (tr.stack(losses, dim=0) * sub_batch_weights).sum(dim=0)
         return loss, out_data_dict, out_fx_params
 
     def training_step(self, batch: (T, T, T, Dict[str, T]), batch_idx: int) -> T:
@@ -217,9 +217,13 @@ class TBPTTLFOEffectModeling(BaseLightingModule):
                  max_n_corners: int = 16,
                  stretch_smooth_n_frames: int = 0,
                  discard_invalid_lfos: bool = True,
-                 loss_dict: Optional[Dict[str, float]] = None) -> None:
+                 loss_dict: Optional[Dict[str, float]] = None,
+                 eval_chunk_n_samples: Optional[int] = None,
+                 lfo_grad_mode: str = "per_step") -> None:
         super().__init__(loss_dict)
         assert warmup_n_samples > 0
+        assert eval_chunk_n_samples is None or eval_chunk_n_samples > 0
+        assert lfo_grad_mode in {"per_step", "accumulate"}
         self.warmup_n_samples = warmup_n_samples
         self.step_n_samples = step_n_samples
         self.effect_model = effect_model
@@ -233,6 +237,12 @@ class TBPTTLFOEffectModeling(BaseLightingModule):
         self.max_n_corners = max_n_corners
         self.stretch_smooth_n_frames = stretch_smooth_n_frames
         self.discard_invalid_lfos = discard_invalid_lfos
+        # Validation has no backward pass, so everything after the warmup is processed in chunks of this size (all at
+        # once if None) instead of step_n_samples
+        self.eval_chunk_n_samples = eval_chunk_n_samples
+        # Only used when the LFO model is trained. "per_step" runs and updates the LFO model at every TBPTT step,
+        # "accumulate" runs it once per batch and updates it once with the gradients of all steps
+        self.lfo_grad_mode = lfo_grad_mode
 
         if lfo_model is not None:
             if lfo_model_weights_path is not None:
@@ -299,6 +309,24 @@ class TBPTTLFOEffectModeling(BaseLightingModule):
         removed_n_frames = orig_n_frames - new_n_frames
         return mod_sig_hat, mod_sig, removed_n_frames
 
+    def eval_effect_model(self, dry: T, mod_sig_hat_sr: T, param_latent: Optional[T] = None) -> List[T]:
+        # Covers the same samples after the warmup as the TBPTT steps, but in eval_chunk_n_samples chunks
+        n_steps = (dry.size(-1) - self.warmup_n_samples) // self.step_n_samples
+        end_idx = self.warmup_n_samples + (n_steps * self.step_n_samples)
+        chunk_n_samples = self.eval_chunk_n_samples
+        if chunk_n_samples is None:
+            chunk_n_samples = max(1, end_idx - self.warmup_n_samples)
+        wet_hat_chunks = []
+        for start_idx in range(self.warmup_n_samples, end_idx, chunk_n_samples):
+            chunk_end_idx = min(start_idx + chunk_n_samples, end_idx)
+            chunk_latent_sr = mod_sig_hat_sr[:, :, start_idx:chunk_end_idx]
+            if param_latent is not None:
+                chunk_param_latent_sr = param_latent.repeat(1, 1, chunk_end_idx - start_idx)
+                chunk_latent_sr = tr.cat([chunk_latent_sr, chunk_param_latent_sr], dim=1)
+            chunk_dry = dry[:, :, start_idx:chunk_end_idx]
+            wet_hat_chunks.append(self.effect_model(chunk_dry, chunk_latent_sr))
+        return wet_hat_chunks
+
     def common_step(self,
                     batch: (T, T, Optional[T], Optional[Dict[str, T]]),
                     is_training: bool) -> (T, Dict[str, T], Optional[Dict[str, T]]):
@@ -322,21 +350,38 @@ class TBPTTLFOEffectModeling(BaseLightingModule):
         dry = self.center_crop_mod_sig(dry, n_samples)
         wet = self.center_crop_mod_sig(wet, n_samples)
 
+        valid_mask = None
         if self.discard_invalid_lfos:
-            valid_indices = find_valid_mod_sig_indices(mod_sig_hat)
-            if not valid_indices:
+            valid_mask = find_valid_mod_sig_mask(mod_sig_hat)
+            if not valid_mask.any():
                 log.info("No valid LFO signals found")
                 return None
-            # log.info(f"Found {len(valid_indices)} valid LFO signals")
-            dry = dry[valid_indices, ...]
-            wet = wet[valid_indices, ...]
-            mod_sig_hat = mod_sig_hat[valid_indices, ...]
+            dry = dry[valid_mask, ...]
+            wet = wet[valid_mask, ...]
+            mod_sig_hat = mod_sig_hat[valid_mask, ...]
             if mod_sig is not None:
-                mod_sig = mod_sig[valid_indices, ...]
+                mod_sig = mod_sig[valid_mask, ...]
 
         mod_sig_hat_sr = linear_interpolate_last_dim(mod_sig_hat, dry.size(-1), align_corners=True)
         mod_sig_hat_sr = mod_sig_hat_sr.unsqueeze(1)
 
+        lfo_graph_sr = None
+        if is_training and self.lfo_grad_mode == "accumulate" and mod_sig_hat_sr.requires_grad:
+            # The steps backpropagate into a detached leaf, its gradient is backpropagated through the LFO model once
+            # at the end of the batch. Grads are set to None so the optimizer skips the LFO model until then.
+            lfo_graph_sr = mod_sig_hat_sr
+            mod_sig_hat_sr = mod_sig_hat_sr.detach().requires_grad_(True)
+        set_to_none = lfo_graph_sr is not None
+
+        # The ground truth mod_sig and frozen LFO models give the same mod_sig_hat at every step
+        is_lfo_per_step = self.lfo_model is not None and not self.freeze_lfo_model and lfo_graph_sr is None
+
+        lstm_in = None
+        if is_training and isinstance(self.effect_model, BufferedLSTMEffectModel) and self.param_model is None \
+                and not is_lfo_per_step:
+            # The effect model inputs are the same for every step, so they are built once and sliced for every step
+            lstm_in = self.effect_model.build_lstm_in(dry, mod_sig_hat_sr)
+
         self.effect_model.clear_hidden()
         warmup_latent_sr = mod_sig_hat_sr[:, :, :self.warmup_n_samples]
 
@@ -347,41 +392,56 @@ class TBPTTLFOEffectModeling(BaseLightingModule):
             warmup_latent_sr = tr.cat([warmup_latent_sr, warmup_param_latent_sr], dim=1)
 
         warmup_dry = dry[:, :, :self.warmup_n_samples]
-        warmup_wet_hat = self.effect_model(warmup_dry, warmup_latent_sr)
+        if lstm_in is None:
+            warmup_wet_hat = self.effect_model(warmup_dry, warmup_latent_sr)
+        else:
+            warmup_wet_hat = self.effect_model.forward_lstm_in(warmup_dry, lstm_in[:, :self.warmup_n_samples, :])
         if is_training:
             self.effect_model.detach_hidden()
-            opt.zero_grad()
+            opt.zero_grad(set_to_none=set_to_none)
 
         wet_hat_chunks = [warmup_wet_hat]
-        for start_idx in range(self.warmup_n_samples, dry.size(-1), self.step_n_samples):
-            end_idx = start_idx + self.step_n_samples
-            if end_idx > dry.size(-1):
-                break
-
-            if is_training and not self.freeze_lfo_model:
-                mod_sig_hat, mod_sig = self.extract_mod_sig(lfo_model_input, mod_sig, fx_params)
-                mod_sig_hat, mod_sig, _ = self.smooth_stretch_crop_mod_sig(mod_sig_hat, mod_sig)
-                mod_sig_hat_sr = linear_interpolate_last_dim(mod_sig_hat, dry.size(-1), align_corners=True)
-                mod_sig_hat_sr = mod_sig_hat_sr.unsqueeze(1)
-
-            step_latent_sr = mod_sig_hat_sr[:, :, start_idx:end_idx]
-            step_dry = dry[:, :, start_idx:end_idx]
-            step_wet = wet[:, :, start_idx:end_idx]
-
-            if self.param_model is not None:
-                if is_training:
+        if not is_training:
+            wet_hat_chunks.extend(self.eval_effect_model(dry, mod_sig_hat_sr, param_latent))
+        else:
+            for start_idx in range(self.warmup_n_samples, dry.size(-1), self.step_n_samples):
+                end_idx = start_idx + self.step_n_samples
+                if end_idx > dry.size(-1):
+                    break
+
+                if is_lfo_per_step:
+                    mod_sig_hat, _ = self.extract_mod_sig(lfo_model_input, fx_params=fx_params)
+                    mod_sig_hat, _, _ = self.smooth_stretch_crop_mod_sig(mod_sig_hat)
+                    if valid_mask is not None:
+                        # The LFO model sees the entire batch, keep the same examples as during warmup
+                        mod_sig_hat = mod_sig_hat[valid_mask, ...]
+                    mod_sig_hat_sr = linear_interpolate_last_dim(mod_sig_hat, dry.size(-1), align_corners=True)
+                    mod_sig_hat_sr = mod_sig_hat_sr.unsqueeze(1)
+
+                step_latent_sr = mod_sig_hat_sr[:, :, start_idx:end_idx]
+                step_dry = dry[:, :, start_idx:end_idx]
+                step_wet = wet[:, :, start_idx:end_idx]
+
+                if self.param_model is not None:
                     param_latent = self.param_model(wet).unsqueeze(-1)
-                step_param_latent_sr = param_latent.repeat(1, 1, self.step_n_samples)
-                step_latent_sr = tr.cat([step_latent_sr, step_param_latent_sr], dim=1)
+                    step_param_latent_sr = param_latent.repeat(1, 1, self.step_n_samples)
+                    step_latent_sr = tr.cat([step_latent_sr, step_param_latent_sr], dim=1)
 
-            step_wet_hat = self.effect_model(step_dry, step_latent_sr)
-            wet_hat_chunks.append(step_wet_hat)
-            if is_training:
+                if lstm_in is None:
+                    step_wet_hat = self.effect_model(step_dry, step_latent_sr)
+                else:
+                    step_wet_hat = self.effect_model.forward_lstm_in(step_dry, lstm_in[:, start_idx:end_idx, :])
+                wet_hat_chunks.append(step_wet_hat)
                 step_loss = self.calc_and_log_losses(step_wet_hat, step_wet, prefix, should_log=False)
                 self.manual_backward(step_loss)
                 opt.step()
                 self.effect_model.detach_hidden()
-                opt.zero_grad()
+                opt.zero_grad(set_to_none=set_to_none)
+
+            if lfo_graph_sr is not None and mod_sig_hat_sr.grad is not None:
+                self.manual_backward(lfo_graph_sr, mod_sig_hat_sr.grad)
+                opt.step()
+                opt.zero_grad(set_to_none=True)
 
         wet_hat = tr.cat(wet_hat_chunks, dim=-1)
         wet_hat_n_samples = wet_hat.size(-1)
@@ -393,17 +453,15 @@ class TBPTTLFOEffectModeling(BaseLightingModule):
         assert dry.shape == wet.shape == wet_hat.shape
 
         batch_loss = self.calc_and_log_losses(wet_hat, wet, prefix, should_log=True)
+        # Kept on the device, the callbacks only copy the examples they log to the CPU
         data_dict = {
-            "dry": dry.detach().float().cpu(),
-            "wet": wet.detach().float().cpu(),
-            "wet_hat": wet_hat.detach().float().cpu(),
-            "mod_sig_hat": mod_sig_hat.detach().float().cpu(),
+            "dry": dry.detach(),
+            "wet": wet.detach(),
+            "wet_hat": wet_hat.detach(),
+            "mod_sig_hat": mod_sig_hat.detach(),
         }
         if mod_sig is not None:
-            data_dict["mod_sig"] = mod_sig.detach().float().cpu()
-
-        if fx_params is not None:
-            fx_params = {k: v.detach().float().cpu() if isinstance(v, T) else v for k, v in fx_params.items()}
+            data_dict["mod_sig"] = mod_sig.detach()
 
         # Debugging loop
         # if wet.size(0) < 15:
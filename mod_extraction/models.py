@@ -1,7 +1,8 @@
 import logging
 import math
 import os
-from typing import Optional, List, Tuple, Dict
+import weakref
+from typing import Any, Callable, Optional, List, Tuple, Dict
 
 import torch as tr
 from torch import Tensor as T
@@ -9,7 +10,7 @@ from torch import nn
 from torchaudio.transforms import Spectrogram, MelSpectrogram, FrequencyMasking, TimeMasking
 
 from mod_extraction.modulations import make_rand_mod_signal
-from mod_extraction.tcn import TCN
+from mod_extraction.tcn import TCN, make_ln
 
 logging.basicConfig()
 log = logging.getLogger(__name__)
@@ -27,7 +28,8 @@ class RandomLFO(nn.Module):
                  freq_min: float = 0.5,
                  freq_max: float = 3.0,
                  phase_error: float = 0.0,
-                 freq_error: float = 0.0) -> None:
+                 freq_error: float = 0.0,
+                 use_wavetable: bool = False) -> None:
         super().__init__()
         self.n_samples = n_samples
         self.sr = sr
@@ -39,6 +41,7 @@ class RandomLFO(nn.Module):
         self.freq_max = freq_max
         self.phase_error = phase_error
         self.freq_error = freq_error
+        self.use_wavetable = use_wavetable
 
     def forward(self, batch_size: int, fx_params: Optional[Dict[str, T]] = None) -> T:
         shapes_gt = None
@@ -66,9 +69,39 @@ class RandomLFO(nn.Module):
             self.phase_error,
             freq_gt,
             self.freq_error,
+            self.use_wavetable,
         ).unsqueeze(1)
 
 
+class FeatureCache:
+    # Remembers the front-end features of the last input tensor. Calls with the same tensor object that has not been
+    # modified in place since reuse the features instead of recomputing the STFT. Staleness is detected with the
+    # private Tensor._version, so the models only use it when use_feature_cache is set and they are in eval mode.
+    def __init__(self) -> None:
+        self.x_ref = None
+        self.x_version = None
+        self.features = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"x_ref": None, "x_version": None, "features": None}
+
+    def clear(self) -> None:
+        self.x_ref = None
+        self.x_version = None
+        self.features = None
+
+    def get(self, x: T, calc_features: Callable[[T], T]) -> T:
+        if x.requires_grad:
+            return calc_features(x)
+        if self.x_ref is not None and self.x_ref() is x and self.x_version == x._version:
+            return self.features
+        features = calc_features(x)
+        self.x_ref = weakref.ref(x)
+        self.x_version = x._version
+        self.features = features
+        return features
+
+
 class SpectralTCN(nn.Module):
     def __init__(self,
                  n_samples: int = 88200,
@@ -80,7 +113,9 @@ class SpectralTCN(nn.Module):
                  latent_dim: int = 1,
                  use_ln: bool = True,
                  use_res: bool = True,
-                 eps: float = 1e-7) -> None:
+                 eps: float = 1e-7,
+                 use_feature_cache: bool = False,
+                 ln_mode: str = "fixed") -> None:
         super().__init__()
         self.n_fft = n_fft
         self.hop_len = hop_len
@@ -89,6 +124,9 @@ class SpectralTCN(nn.Module):
         self.use_ln = use_ln
         self.use_res = use_res
         self.eps = eps
+        self.use_feature_cache = use_feature_cache
+        self.feature_cache = FeatureCache()
+        self.ln_mode = ln_mode
         if out_channels is None:
             out_channels = [96] * 5
         self.out_channels = out_channels
@@ -109,16 +147,24 @@ class SpectralTCN(nn.Module):
                        use_ln=use_ln,
                        temporal_dims=temporal_dims,
                        use_res=use_res,
-                       is_causal=False)
+                       is_causal=False,
+                       ln_mode=ln_mode)
         self.receptive_field = self.tcn.calc_receptive_field()
         log.info(f"Receptive field = {self.receptive_field} samples")
         self.output = nn.Conv1d(out_channels[-1], self.latent_dim, kernel_size=(1,))
 
-    def forward(self, x: T) -> T:
-        assert x.ndim == 3
+    def calc_features(self, x: T) -> T:
         x = self.spectrogram(x).squeeze(1)
         x = tr.clip(x, min=self.eps)
         x = tr.log(x)
+        return x
+
+    def forward(self, x: T) -> T:
+        assert x.ndim == 3
+        if self.use_feature_cache and not self.training:
+            x = self.feature_cache.get(x, self.calc_features)
+        else:
+            x = self.calc_features(x)
         x = self.tcn(x)
         x = self.output(x)
         x = tr.sigmoid(x)
@@ -142,8 +188,11 @@ class Spectral2DCNN(nn.Module):
                  freq_mask_amount: float = 0.0,
                  time_mask_amount: float = 0.0,
                  use_ln: bool = True,
-                 eps: float = 1e-7) -> None:
+                 eps: float = 1e-7,
+                 use_feature_cache: bool = False,
+                 ln_mode: str = "fixed") -> None:
         super().__init__()
+        self.in_ch = in_ch
         self.sr = sr
         self.n_fft = n_fft
         self.hop_len = hop_len
@@ -156,6 +205,9 @@ class Spectral2DCNN(nn.Module):
         self.time_mask_amount = time_mask_amount
         self.use_ln = use_ln
         self.eps = eps
+        self.use_feature_cache = use_feature_cache
+        self.feature_cache = FeatureCache()
+        self.ln_mode = ln_mode
         if out_channels is None:
             out_channels = [64] * 5
         self.out_channels = out_channels
@@ -183,7 +235,7 @@ class Spectral2DCNN(nn.Module):
         layers = []
         for out_ch, b_dil, t_dil, temp_dim in zip(out_channels, bin_dilations, temp_dilations, temporal_dims):
             if use_ln:
-                layers.append(nn.LayerNorm([n_bins, temp_dim], elementwise_affine=False))
+                layers.append(make_ln(ln_mode, n_bins, temp_dim))
             layers.append(nn.Conv2d(in_ch, out_ch, kernel_size, stride=(1, 1), dilation=(b_dil, t_dil), padding="same"))
             layers.append(nn.MaxPool2d(kernel_size=pool_size))
             layers.append(nn.PReLU(num_parameters=out_ch))
@@ -196,7 +248,11 @@ class Spectral2DCNN(nn.Module):
 
     def forward(self, x: T) -> (T, T):
         assert x.ndim == 3
-        x = self.spectrogram(x)
+        # Only the spectrogram is cached since the masking is random and clip and log have to follow it
+        if self.use_feature_cache and not self.training:
+            x = self.feature_cache.get(x, self.spectrogram)
+        else:
+            x = self.spectrogram(x)
 
         if self.training:
             if self.freq_mask_amount > 0:
@@ -228,7 +284,9 @@ class SpectralDSTCN(nn.Module):
                  latent_dim: int = 2,
                  use_ln: bool = True,
                  use_res: bool = True,
-                 eps: float = 1e-7) -> None:
+                 eps: float = 1e-7,
+                 use_feature_cache: bool = False,
+                 ln_mode: str = "fixed") -> None:
         super().__init__()
         self.n_fft = n_fft
         self.hop_len = hop_len
@@ -238,6 +296,9 @@ class SpectralDSTCN(nn.Module):
         self.use_ln = use_ln
         self.use_res = use_res
         self.eps = eps
+        self.use_feature_cache = use_feature_cache
+        self.feature_cache = FeatureCache()
+        self.ln_mode = ln_mode
 
         if out_channels is None:
             out_channels = [96] * 5
@@ -268,16 +329,24 @@ class SpectralDSTCN(nn.Module):
                        use_ln=use_ln,
                        temporal_dims=temporal_dims,
                        use_res=use_res,
-                       is_causal=False)
+                       is_causal=False,
+                       ln_mode=ln_mode)
         self.fc = nn.Linear(out_channels[-1], self.n_fc_units)
         self.fc_act = nn.PReLU(self.n_fc_units)
         self.output = nn.Linear(self.n_fc_units, self.latent_dim)
 
-    def forward(self, x: T) -> T:
-        assert x.ndim == 3
+    def calc_features(self, x: T) -> T:
         x = self.spectrogram(x).squeeze(1)
         x = tr.clip(x, min=self.eps)
         x = tr.log(x)
+        return x
+
+    def forward(self, x: T) -> T:
+        assert x.ndim == 3
+        if self.use_feature_cache and not self.training:
+            x = self.feature_cache.get(x, self.calc_features)
+        else:
+            x = self.calc_features(x)
 
         x = self.tcn(x)
         x = tr.mean(x, dim=-1)
@@ -301,8 +370,8 @@ class HiddenStateModel(nn.Module):
 
     def detach_hidden(self) -> None:
         if self.is_hidden_init:
-            # TODO(cm): check whether clone is required or not
-            self.hidden = tuple((h.detach().clone() for h in self.hidden))
+            # No clone is required since the LSTM never modifies the hidden state in place
+            self.hidden = (self.hidden[0].detach(), self.hidden[1].detach())
 
     def clear_hidden(self) -> None:
         self.is_hidden_init = False
@@ -339,6 +408,60 @@ class LSTMEffectModel(HiddenStateModel):
         return y_hat
 
 
+class BufferedLSTMEffectModel(LSTMEffectModel):
+    # Same parameters and outputs as LSTMEffectModel with fewer copies per TBPTT step. When training, the LSTM input of
+    # the entire batch can be built once with build_lstm_in and sliced for every step with forward_lstm_in. Otherwise
+    # the LSTM input goes into a preallocated buffer when no graph is being recorded. The residual and tanh are applied
+    # in place to the output of the linear layer.
+    def __init__(self,
+                 in_ch: int = 1,
+                 out_ch: int = 1,
+                 n_hidden: int = 64,
+                 latent_dim: int = 1) -> None:
+        super().__init__(in_ch, out_ch, n_hidden, latent_dim)
+        self.register_buffer("lstm_in_buf", tr.zeros((1, 1, latent_dim + in_ch)), persistent=False)
+
+    def build_lstm_in(self, x: T, latent: T) -> T:
+        # (B, n_samples, latent_dim + in_ch), a new tensor so it can be part of a graph and sliced across steps
+        assert x.ndim == 3
+        assert latent.shape == (x.size(0), self.latent_dim, x.size(-1))
+        return tr.cat([latent.transpose(1, 2), x.transpose(1, 2)], dim=2)
+
+    def make_lstm_in(self, x: T, latent: T) -> T:
+        if tr.is_grad_enabled():
+            # The buffer cannot be reused while it is part of a graph
+            return self.build_lstm_in(x, latent)
+        bs = x.size(0)
+        n_samples = x.size(-1)
+        # Buffers created in inference mode cannot be written to outside of it (e.g. validation followed by no_grad)
+        if self.lstm_in_buf.shape != (bs, n_samples, self.latent_dim + self.in_ch) \
+                or self.lstm_in_buf.device != x.device \
+                or self.lstm_in_buf.is_inference() != tr.is_inference_mode_enabled():
+            self.lstm_in_buf = tr.empty((bs, n_samples, self.latent_dim + self.in_ch), device=x.device)
+        self.lstm_in_buf[:, :, :self.latent_dim].copy_(latent.transpose(1, 2))
+        self.lstm_in_buf[:, :, self.latent_dim:].copy_(x.transpose(1, 2))
+        return self.lstm_in_buf
+
+    def forward_lstm_in(self, x: T, lstm_in: T) -> T:
+        assert x.ndim == 3
+        assert lstm_in.shape == (x.size(0), x.size(-1), self.latent_dim + self.in_ch)
+        if self.is_hidden_init:
+            lstm_out, new_hidden = self.lstm(lstm_in, self.hidden)
+        else:
+            lstm_out, new_hidden = self.lstm(lstm_in)
+        fc_out = self.fc(lstm_out)
+        y_hat = fc_out.transpose(1, 2)
+        y_hat = tr.tanh_(y_hat.add_(x))
+        self.update_hidden(new_hidden)
+        return y_hat
+
+    def forward(self, x: T, latent: T) -> T:
+        assert x.ndim == 3
+        assert latent.shape == (x.size(0), self.latent_dim, x.size(-1))
+        lstm_in = self.make_lstm_in(x, latent)
+        return self.forward_lstm_in(x, lstm_in)
+
+
 if __name__ == "__main__":
     model = Spectral2DCNN()
     audio = tr.rand((3, 1, 88200))
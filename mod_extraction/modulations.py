@@ -1,10 +1,11 @@
 # TODO(cm): refactor file, the logic is difficult to follow in a lot of these methods
 import logging
+import math
 import os
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Union
 
 import torch as tr
-from torch import Tensor as T
+from torch import Tensor as T, nn
 
 from mod_extraction import util
 
@@ -12,17 +13,21 @@ logging.basicConfig()
 log = logging.getLogger(__name__)
 log.setLevel(level=os.environ.get('LOGLEVEL', 'INFO'))
 
+# The index of a shape is its shape code in fx_params
+SHAPES = ["cos", "rect_cos", "inv_rect_cos", "tri", "saw", "rsaw", "sqr"]
+
 
 def make_mod_signal(n_samples: int,
                     sr: float,
                     freq: float,
                     phase: float = 0.0,
                     shape: str = "cos",
-                    exp: float = 1.0) -> T:
+                    exp: float = 1.0,
+                    use_wavetable: bool = False) -> T:
     assert n_samples > 0
     assert 0.0 < freq < sr / 2.0
     assert -2 * tr.pi <= phase <= 2 * tr.pi
-    assert shape in {"cos", "rect_cos", "inv_rect_cos", "tri", "saw", "rsaw", "sqr"}
+    assert shape in SHAPES
     if shape in {"rect_cos", "inv_rect_cos"}:
         # Rectified sine waves have double the frequency
         freq /= 2.0
@@ -31,7 +36,9 @@ def make_mod_signal(n_samples: int,
     argument = tr.cumsum(2 * tr.pi * tr.full((n_samples,), freq) / sr, dim=0) + phase
     saw = tr.remainder(argument, 2 * tr.pi) / (2 * tr.pi)
 
-    if shape == "cos":
+    if use_wavetable:
+        mod_sig = get_lfo_wavetable(argument.device)(argument, tr.tensor(SHAPES.index(shape)))
+    elif shape == "cos":
         mod_sig = (tr.cos(argument + tr.pi) + 1.0) / 2.0
     elif shape == "rect_cos":
         mod_sig = tr.abs(tr.cos(argument + (tr.pi / 2.0)))
@@ -57,47 +64,290 @@ def make_mod_signal(n_samples: int,
     return mod_sig
 
 
+def make_mod_signal_batched(n_samples: int,
+                            sr: float,
+                            freq: T,
+                            phase: T,
+                            shape_codes: T,
+                            exp: Optional[T] = None,
+                            use_wavetable: bool = False) -> T:
+    # Batched version of make_mod_signal, every row follows the exact same sequence of float ops as make_mod_signal with
+    # the same row parameters. Unlike make_mod_signal, the parameter ranges are not checked to avoid device syncs.
+    assert n_samples > 0
+    assert freq.ndim == phase.ndim == shape_codes.ndim == 1
+    assert freq.shape == phase.shape == shape_codes.shape
+    # Items without a shape (NO_SHAPE_CODE in fx_params) would otherwise silently become all zero LFOs
+    assert (shape_codes >= 0).all(), "Every item needs a shape to generate a mod_sig"
+    freq = freq.float().view(-1, 1)
+    phase = phase.float().view(-1, 1)
+    shape_codes = shape_codes.view(-1, 1)
+    is_rect = (shape_codes == SHAPES.index("rect_cos")) | (shape_codes == SHAPES.index("inv_rect_cos"))
+    # Rectified sine waves have double the frequency
+    freq = tr.where(is_rect, freq / 2.0, freq)
+    phase = tr.where(is_rect, phase / 2.0, phase)
+    argument = tr.cumsum(2 * tr.pi * freq.expand(-1, n_samples) / sr, dim=1) + phase
+    if use_wavetable:
+        mod_sig = get_lfo_wavetable(argument.device)(argument, shape_codes)
+    else:
+        mod_sig = _apply_shapes(argument, shape_codes)
+    if exp is not None:
+        exp = exp.float().view(-1, 1)
+        mod_sig = tr.where(exp != 1.0, mod_sig ** exp, mod_sig)
+    return mod_sig
+
+
+def _apply_shapes(argument: T, shape_codes: T, saw: Optional[T] = None) -> T:
+    # shape_codes can be per row (B, 1) or per sample (B, n)
+    if saw is None:
+        saw = tr.remainder(argument, 2 * tr.pi) / (2 * tr.pi)
+    # Every shape is computed for the entire batch and then selected, which avoids a sync to find the shapes present
+    mod_sig = tr.zeros_like(argument)
+    for code, shape in enumerate(SHAPES):
+        if shape == "cos":
+            shape_mod_sig = (tr.cos(argument + tr.pi) + 1.0) / 2.0
+        elif shape == "rect_cos":
+            shape_mod_sig = tr.abs(tr.cos(argument + (tr.pi / 2.0)))
+        elif shape == "inv_rect_cos":
+            shape_mod_sig = -tr.abs(tr.cos(argument)) + 1.0
+        elif shape == "sqr":
+            cos = tr.cos(argument + tr.pi)
+            sqr = tr.sign(cos)
+            shape_mod_sig = (sqr + 1.0) / 2.0
+        elif shape == "saw":
+            shape_mod_sig = saw
+        elif shape == "rsaw":
+            shape_mod_sig = 1.0 - saw
+        elif shape == "tri":
+            tri = 2 * saw
+            shape_mod_sig = tr.where(tri > 1.0, 2.0 - tri, tri)
+        else:
+            raise ValueError("Unsupported shape")
+        mod_sig = tr.where(shape_codes == code, shape_mod_sig, mod_sig)
+    return mod_sig
+
+
+class LFOWavetable(nn.Module):
+    # One period of every shape in SHAPES, rendered by linear interpolation into the table instead of evaluating the
+    # shape functions. forward() is a drop-in replacement for _apply_shapes and can be scripted.
+    def __init__(self, table_size: int = 4096) -> None:
+        super().__init__()
+        assert table_size > 1
+        self.table_size = table_size
+        # The extra sample at the end of every row is the end of the period, so no wrapping is needed when reading
+        cycle_pos = tr.linspace(0.0, 1.0, table_size + 1).unsqueeze(0).expand(len(SHAPES), -1)
+        # Rectified sine waves complete a period over half of the argument range of the other shapes
+        periods = tr.full((len(SHAPES), 1), 2 * math.pi)
+        periods[1:3] = math.pi  # rect_cos, inv_rect_cos
+        tables = _apply_shapes(periods * cycle_pos, tr.arange(len(SHAPES)).view(-1, 1), saw=cycle_pos)
+        self.register_buffer("tables", tables.contiguous(), persistent=False)
+        self.register_buffer("periods", periods.view(-1), persistent=False)
+        # sqr jumps inside the period, so it is read with a step lookup instead of being interpolated across the jump.
+        # saw and rsaw only jump at the end of the period, which the guard sample and the remainder already handle.
+        is_step = tr.tensor([shape == "sqr" for shape in SHAPES])
+        self.register_buffer("is_step", is_step, persistent=False)
+
+    def forward(self, argument: T, shape_codes: T) -> T:
+        shape_codes = shape_codes.to(argument.device).long()
+        table_pos = tr.remainder(argument / self.periods[shape_codes], 1.0) * self.table_size
+        lo = tr.clip(tr.floor(table_pos).long(), 0, self.table_size - 1)
+        frac = table_pos - lo.float()
+        frac = tr.where(self.is_step[shape_codes], tr.zeros_like(frac), frac)
+        flat_indices = (shape_codes * (self.table_size + 1)) + lo
+        flat_tables = self.tables.view(-1)
+        lo_vals = flat_tables[flat_indices]
+        hi_vals = flat_tables[flat_indices + 1]
+        return lo_vals + (frac * (hi_vals - lo_vals))
+
+
+_lfo_wavetables: Dict[str, LFOWavetable] = {}
+
+
+def get_lfo_wavetable(device: Optional[tr.device] = None) -> LFOWavetable:
+    # Shared per device, the tables are only built once per process
+    key = str(device)
+    if key not in _lfo_wavetables:
+        _lfo_wavetables[key] = LFOWavetable().to(device)
+    return _lfo_wavetables[key]
+
+
+def make_warped_mod_signal_batched(n_samples: int,
+                                   sr: float,
+                                   freq: T,
+                                   phase: T,
+                                   shape_codes: T,
+                                   cycle_stretch: Optional[T] = None,
+                                   cycle_shape_codes: Optional[T] = None,
+                                   use_wavetable: bool = False) -> T:
+    # Generates the LFOs in cycle coordinates (c = argument / 2pi) using a piecewise linear time map. Cycle k spans
+    # [floor(c_0) + k, floor(c_0) + k + 1] (the first one starts at c_0) which is where every shape has a corner.
+    # cycle_stretch (B, n_cycles) multiplies the duration of every cycle and cycle_shape_codes (B, n_cycles)
+    # overrides the shape of every cycle after the first.
+    assert n_samples > 0
+    assert freq.shape == phase.shape == shape_codes.shape
+    assert (shape_codes >= 0).all(), "Every item needs a shape to generate a mod_sig"
+    if cycle_shape_codes is not None:
+        assert (cycle_shape_codes >= 0).all(), "Every cycle needs a shape to generate a mod_sig"
+    bs = freq.size(0)
+    device = freq.device
+    freq = freq.float().view(-1, 1)
+    phase = phase.float().view(-1, 1)
+    c_0 = phase / (2 * tr.pi)
+    if cycle_stretch is None:
+        cycle_stretch = tr.ones((bs, 1), device=device)
+    n_cycles = cycle_stretch.size(1)
+    assert cycle_stretch.shape == (bs, n_cycles)
+
+    cycle_starts = tr.floor(c_0) + tr.arange(n_cycles, device=device).view(1, -1)
+    cycle_starts[:, :1] = c_0
+    cycle_ends = tr.floor(c_0) + tr.arange(1, n_cycles + 1, device=device).view(1, -1)
+    cycle_n_samples = (cycle_ends - cycle_starts) * (sr / freq) * cycle_stretch
+    cycle_offsets = tr.cumsum(cycle_n_samples, dim=1) - cycle_n_samples
+
+    # Same sample positions as the cumsum in make_mod_signal, the last cycle is extended to cover any remaining samples
+    t = tr.arange(1, n_samples + 1, device=device, dtype=tr.float).view(1, -1).expand(bs, -1).contiguous()
+    cycle_indices = tr.searchsorted(cycle_offsets.contiguous(), t, right=True) - 1
+    cycle_indices = tr.clip(cycle_indices, 0, n_cycles - 1)
+    c = (t - cycle_offsets.gather(1, cycle_indices)) * freq / (sr * cycle_stretch.gather(1, cycle_indices))
+    c = cycle_starts.gather(1, cycle_indices) + c
+    argument = 2 * tr.pi * c
+
+    shape_codes = shape_codes.view(-1, 1)
+    if cycle_shape_codes is not None:
+        assert cycle_shape_codes.shape == (bs, n_cycles)
+        shape_codes = tr.where(cycle_indices == 0, shape_codes, cycle_shape_codes.gather(1, cycle_indices))
+    # Rectified sine waves have double the frequency
+    is_rect = (shape_codes == SHAPES.index("rect_cos")) | (shape_codes == SHAPES.index("inv_rect_cos"))
+    argument = tr.where(is_rect, argument / 2.0, argument)
+    if use_wavetable:
+        return get_lfo_wavetable(argument.device)(argument, shape_codes)
+    return _apply_shapes(argument, shape_codes)
+
+
+def calc_max_n_cycles(n_samples: int, sr: float, freq: T, min_stretch: float = 1.0) -> int:
+    # Upper bound on the number of cycles the warped LFOs can contain, requires a single device sync
+    assert min_stretch > 0.0
+    max_freq = freq.max().item()
+    return int(math.ceil(max_freq * n_samples / sr / min_stretch)) + 2
+
+
+def sample_cycle_stretch(batch_size: int,
+                         n_cycles: int,
+                         l_min: float = 0.2,
+                         l_max: float = 0.2,
+                         r_min: float = 0.2,
+                         r_max: float = 0.2,
+                         lr_split: float = 0.5,
+                         device: Optional[tr.device] = None) -> T:
+    # Every cycle is shortened by [l_min, l_max] of its length with probability lr_split and lengthened by
+    # [r_min, r_max] otherwise, like the sections in make_quasi_periodic
+    assert 0.0 <= l_min <= l_max < 1.0
+    assert 0.0 <= r_min <= r_max
+    shorten = 1.0 - ((tr.rand((batch_size, n_cycles), device=device) * (l_max - l_min)) + l_min)
+    lengthen = 1.0 + ((tr.rand((batch_size, n_cycles), device=device) * (r_max - r_min)) + r_min)
+    return tr.where(tr.rand((batch_size, n_cycles), device=device) < lr_split, shorten, lengthen)
+
+
+def make_quasi_periodic_batched(n_samples: int,
+                                sr: float,
+                                freq: T,
+                                phase: T,
+                                shape_codes: T,
+                                exp: Optional[T] = None,
+                                l_min: float = 0.2,
+                                l_max: float = 0.2,
+                                r_min: float = 0.2,
+                                r_max: float = 0.2,
+                                lr_split: float = 0.5,
+                                use_wavetable: bool = False) -> T:
+    n_cycles = calc_max_n_cycles(n_samples, sr, freq, min_stretch=1.0 - l_max)
+    cycle_stretch = sample_cycle_stretch(freq.size(0), n_cycles, l_min, l_max, r_min, r_max, lr_split, freq.device)
+    mod_sig = make_warped_mod_signal_batched(n_samples,
+                                             sr,
+                                             freq,
+                                             phase,
+                                             shape_codes,
+                                             cycle_stretch=cycle_stretch,
+                                             use_wavetable=use_wavetable)
+    if exp is not None:
+        exp = exp.float().view(-1, 1)
+        mod_sig = tr.where(exp != 1.0, mod_sig ** exp, mod_sig)
+    return mod_sig
+
+
+def make_combined_mod_sig_batched(n_samples: int,
+                                  sr: float,
+                                  freq: T,
+                                  phase: T,
+                                  shapes: List[str],
+                                  cycle_stretch: Optional[T] = None,
+                                  use_wavetable: bool = False) -> T:
+    # Batched equivalent of make_combined_mod_sig: every cycle after the first gets a random shape from shapes
+    bs = freq.size(0)
+    device = freq.device
+    if cycle_stretch is None:
+        n_cycles = calc_max_n_cycles(n_samples, sr, freq)
+        cycle_stretch = tr.ones((bs, n_cycles), device=device)
+    n_cycles = cycle_stretch.size(1)
+    shape_codes = tr.tensor([SHAPES.index(s) for s in shapes], device=device)
+    cycle_shape_codes = shape_codes[tr.randint(0, len(shapes), (bs, n_cycles), device=device)]
+    return make_warped_mod_signal_batched(n_samples,
+                                          sr,
+                                          freq,
+                                          phase,
+                                          cycle_shape_codes[:, 0],
+                                          cycle_stretch=cycle_stretch,
+                                          cycle_shape_codes=cycle_shape_codes,
+                                          use_wavetable=use_wavetable)
+
+
 def make_rand_mod_signal(batch_size: int,
                          n_samples: int,
                          sr: float,
                          freq_min: float,
                          freq_max: float,
-                         shapes_gt: Optional[T] = None,
+                         shapes_gt: Optional[Union[T, List[str]]] = None,
                          shapes: Optional[List[str]] = None,
                          phase_gt: Optional[T] = None,
                          phase_error: float = 0.5,
                          freq_gt: Optional[T] = None,
-                         freq_error: float = 0.25) -> T:
+                         freq_error: float = 0.25,
+                         use_wavetable: bool = False) -> T:
     if shapes is None:
         shapes = ["cos", "tri", "rect_cos", "inv_rect_cos", "saw", "rsaw"]
-    mod_sigs = []
-    for idx in range(batch_size):
-        if phase_gt is not None:
-            assert phase_gt.size(0) == batch_size
-            phase = phase_gt[idx]
-            if phase_error > 0:
-                error = util.sample_uniform(-1.0, 1.0) * tr.pi * phase_error
-                phase += error
-                phase = (phase + (2 * tr.pi)) % (2 * tr.pi)
-        else:
-            phase = util.sample_uniform(0.0, 2 * tr.pi)
-        if freq_gt is not None:
-            assert freq_gt.size(0) == batch_size
-            freq = freq_gt[idx]
-            if freq_error > 0:
-                error = util.sample_uniform(1.0 - freq_error, 1.0 + freq_error)
-                freq *= error
-                freq = tr.clip(freq, freq_min, freq_max)
-        else:
-            freq = util.sample_uniform(freq_min, freq_max)
-        if shapes_gt is not None:
-            assert len(shapes_gt) == batch_size
-            shape = shapes_gt[idx]
+    device = None
+    for gt in [phase_gt, freq_gt, shapes_gt]:
+        if isinstance(gt, T):
+            device = gt.device
+            break
+
+    if phase_gt is not None:
+        assert phase_gt.size(0) == batch_size
+        phase = phase_gt.float()
+        if phase_error > 0:
+            error = ((tr.rand(batch_size, device=device) * 2.0) - 1.0) * tr.pi * phase_error
+            phase = phase + error
+            phase = (phase + (2 * tr.pi)) % (2 * tr.pi)
+    else:
+        phase = tr.rand(batch_size, device=device) * 2 * tr.pi
+    if freq_gt is not None:
+        assert freq_gt.size(0) == batch_size
+        freq = freq_gt.float()
+        if freq_error > 0:
+            error = (tr.rand(batch_size, device=device) * 2.0 * freq_error) + 1.0 - freq_error
+            freq = freq * error
+            freq = tr.clip(freq, freq_min, freq_max)
+    else:
+        freq = (tr.rand(batch_size, device=device) * (freq_max - freq_min)) + freq_min
+    if shapes_gt is not None:
+        assert len(shapes_gt) == batch_size
+        if isinstance(shapes_gt, T):
+            shape_codes = shapes_gt.to(device)
         else:
-            shape = util.choice(shapes)
-        mod_sig = make_mod_signal(n_samples, sr, freq, phase, shape)
-        mod_sigs.append(mod_sig)
-    mod_sigs = tr.stack(mod_sigs, dim=0)
+            shape_codes = tr.tensor([SHAPES.index(s) for s in shapes_gt], device=device)
+    else:
+        shape_codes = tr.tensor([SHAPES.index(s) for s in shapes], device=device)
+        shape_codes = shape_codes[tr.randint(0, len(shapes), (batch_size,), device=device)]
+    mod_sigs = make_mod_signal_batched(n_samples, sr, freq, phase, shape_codes, use_wavetable=use_wavetable)
     return mod_sigs
 
 
@@ -192,9 +442,10 @@ def make_combined_mod_sig(n_samples: int,
                           sr: float,
                           freq: float,
                           phase: float,
-                          shapes: List[str]) -> T:
+                          shapes: List[str],
+                          use_wavetable: bool = False) -> T:
     curr_shape = util.choice(shapes)
-    mod_sig = make_mod_signal(n_samples, sr, freq, phase, shape=curr_shape)
+    mod_sig = make_mod_signal(n_samples, sr, freq, phase, shape=curr_shape, use_wavetable=use_wavetable)
     top_corners, bottom_corners = find_corners(mod_sig.unsqueeze(0))
     corners = bottom_corners
     corners = corners.squeeze(0)
@@ -205,11 +456,65 @@ def make_combined_mod_sig(n_samples: int,
             prev_idx = corner_indices[i]
             section_len = idx - prev_idx + 1
             curr_shape = util.choice(shapes)
-            section = make_mod_signal(section_len, section_len, freq=1.0, phase=0.0, shape=curr_shape)
+            section = make_mod_signal(section_len,
+                                      section_len,
+                                      freq=1.0,
+                                      phase=0.0,
+                                      shape=curr_shape,
+                                      use_wavetable=use_wavetable)
             mod_sig[prev_idx:idx + 1] = section
     return mod_sig
 
 
+def make_mod_sig_from_config_batched(mod_sig_config: Dict[str, Any],
+                                     n_samples: int,
+                                     sr: float,
+                                     freq: T,
+                                     phase: T,
+                                     shape_codes: T,
+                                     exp: Optional[T] = None) -> T:
+    # Batched equivalent of the mod_sig generation in RandomAudioChunkAndModSigDataset
+    use_wavetable = mod_sig_config.get("use_wavetable", False)
+    is_quasiperiodic = mod_sig_config.get("quasiperiodic", False)
+    if mod_sig_config.get("combined", False):
+        cycle_stretch = None
+        if is_quasiperiodic:
+            n_cycles = calc_max_n_cycles(n_samples, sr, freq, min_stretch=1.0 - mod_sig_config["l_max"])
+            cycle_stretch = sample_cycle_stretch(freq.size(0),
+                                                 n_cycles,
+                                                 mod_sig_config["l_min"],
+                                                 mod_sig_config["l_max"],
+                                                 mod_sig_config["r_min"],
+                                                 mod_sig_config["r_max"],
+                                                 mod_sig_config["lr_split"],
+                                                 freq.device)
+        return make_combined_mod_sig_batched(n_samples,
+                                             sr,
+                                             freq,
+                                             phase,
+                                             mod_sig_config["shapes"],
+                                             cycle_stretch,
+                                             use_wavetable)
+    if is_quasiperiodic:
+        return make_quasi_periodic_batched(n_samples,
+                                           sr,
+                                           freq,
+                                           phase,
+                                           shape_codes,
+                                           exp,
+                                           mod_sig_config["l_min"],
+                                           mod_sig_config["l_max"],
+                                           mod_sig_config["r_min"],
+                                           mod_sig_config["r_max"],
+                                           mod_sig_config["lr_split"],
+                                           use_wavetable)
+    mod_sig = make_warped_mod_signal_batched(n_samples, sr, freq, phase, shape_codes, use_wavetable=use_wavetable)
+    if exp is not None:
+        exp = exp.float().view(-1, 1)
+        mod_sig = tr.where(exp != 1.0, mod_sig ** exp, mod_sig)
+    return mod_sig
+
+
 def mod_sig_to_corners(mod_sig: T, n_frames: int) -> (T, T):
     assert mod_sig.ndim == 2
     mod_sig = util.linear_interpolate_last_dim(mod_sig, n_frames, align_corners=True)
@@ -238,56 +543,87 @@ def find_corners(mod_sig: T) -> (T, T):
     return top_corners, bottom_corners
 
 
+def _linspace_segments(start: T, end: T, steps: T, idx: T) -> T:
+    # Element idx of tr.linspace(start, end, steps), computed the same way as the torch kernel which fills the second
+    # half of the output backwards from the end value
+    step = (end - start) / (steps - 1).float()
+    halfway = steps // 2
+    return tr.where(idx < halfway, start + (step * idx.float()), end - (step * (steps - idx - 1).float()))
+
+
+def _find_prev_and_next(is_marked: T) -> (T, T):
+    # Index of the closest marked element at or before (-1 if none) and at or after (n if none) every position
+    n = is_marked.size(-1)
+    indices = tr.arange(n, device=is_marked.device).expand_as(is_marked)
+    prev_indices = tr.cummax(tr.where(is_marked, indices, tr.full_like(indices, -1)), dim=-1).values
+    next_indices = tr.where(is_marked, indices, tr.full_like(indices, n)).flip(-1)
+    next_indices = tr.cummin(next_indices, dim=-1).values.flip(-1)
+    return prev_indices, next_indices
+
+
 def corners_to_mod_sig(top_corners: T, bottom_corners: T) -> T:
-    assert top_corners.ndim == 1
+    assert top_corners.ndim in {1, 2}
     assert top_corners.shape == bottom_corners.shape
-    mod_sig = tr.zeros_like(top_corners).float()
-    if top_corners.max() == 0 or bottom_corners.max() == 0:
-        return mod_sig
-    top_indices = tr.where(top_corners == 1)[0]
-    top_indices = [(v.item(), 1) for v in top_indices]
-    bottom_indices = tr.where(bottom_corners == 1)[0]
-    bottom_indices = [(v.item(), 0) for v in bottom_indices]
-    indices = top_indices + bottom_indices
-    indices.sort(key=lambda x: x[0])
-    for idx in range(len(indices) - 1):
-        l_idx, l_v = indices[idx]
-        r_idx, r_v = indices[idx + 1]
-        mod_sig[l_idx:r_idx + 1] = tr.linspace(l_v, r_v, r_idx - l_idx + 1)
+    if top_corners.ndim == 1:
+        return corners_to_mod_sig(top_corners.unsqueeze(0), bottom_corners.unsqueeze(0)).squeeze(0)
+    n = top_corners.size(-1)
+    is_top = top_corners == 1
+    is_corner = is_top | (bottom_corners == 1)
+    prev_indices, next_indices = _find_prev_and_next(is_corner)
+    is_between = (prev_indices >= 0) & (next_indices < n)
+    prev_indices = tr.clip(prev_indices, 0, n - 1)
+    next_indices = tr.clip(next_indices, 0, n - 1)
+    # Between two corners the signal linearly ramps from one corner value to the other
+    start = is_top.gather(-1, prev_indices).float()
+    end = is_top.gather(-1, next_indices).float()
+    indices = tr.arange(n, device=top_corners.device).expand_as(prev_indices)
+    steps = next_indices - prev_indices + 1
+    mod_sig = _linspace_segments(start, end, steps, indices - prev_indices)
+    mod_sig = tr.where(is_corner, is_top.float(), mod_sig)
+    mod_sig = tr.where(is_between | is_corner, mod_sig, tr.zeros_like(mod_sig))
+    is_valid = is_top.any(dim=-1, keepdim=True) & (bottom_corners == 1).any(dim=-1, keepdim=True)
+    mod_sig = tr.where(is_valid, mod_sig, tr.zeros_like(mod_sig))
     return mod_sig
 
 
 def _stretch_corners(mod_sig: T, top: T, bottom: T, top_val: float = 1.0, bot_val: float = 0.0) -> T:
-    assert mod_sig.ndim == 1
+    # Every corner and the last sample are anchors. The segment between two anchors is shifted to start at 0,
+    # rescaled so that its range matches the range between the target values of the anchors and then shifted to end
+    # on the target value of its closing anchor.
+    assert mod_sig.ndim in {1, 2}
     assert mod_sig.shape == top.shape == bottom.shape
-    top_indices = (top == 1).nonzero(as_tuple=True)[0]
-    top = [(idx.item(), top_val) for idx in top_indices]
-    bottom_indices = (bottom == 1).nonzero(as_tuple=True)[0]
-    bottom = [(idx.item(), bot_val) for idx in bottom_indices]
-    indices = top + bottom + [(mod_sig.size(0) - 1, mod_sig[-1])]
-    if not indices:
-        return mod_sig
-    indices.sort(key=lambda x: x[0])
-
-    prev_mod_idx = 0
-    prev_anchor = mod_sig[0]
-    stretched = tr.clone(mod_sig)
-    for curr_mod_idx, target_val in indices:
-        segment = stretched[prev_mod_idx + 1:curr_mod_idx + 1]
-        curr_val = mod_sig[curr_mod_idx]
-        orig_prev_anchor = mod_sig[prev_mod_idx]
-        if prev_anchor != target_val:
-            curr_range = abs(orig_prev_anchor - curr_val)
-            target_range = abs(prev_anchor - target_val)
-            scale_amount = target_range / curr_range
-            segment -= segment.min()
-            segment *= scale_amount
-            segment += target_val - segment[-1]
-            stretched[prev_mod_idx + 1:curr_mod_idx + 1] = segment
-        prev_mod_idx = curr_mod_idx
-        prev_anchor = target_val
-
-    # assert stretched.max() == top_val or stretched.min() == bot_val
+    if mod_sig.ndim == 1:
+        return _stretch_corners(mod_sig.unsqueeze(0), top.unsqueeze(0), bottom.unsqueeze(0), top_val, bot_val).squeeze(0)
+    n = mod_sig.size(-1)
+    is_top = top == 1
+    is_bottom = bottom == 1
+    is_anchor = is_top | is_bottom
+    is_anchor[:, -1] = True
+    anchor_val = tr.where(is_top, tr.full_like(mod_sig, top_val), mod_sig)
+    anchor_val = tr.where(is_bottom, tr.full_like(mod_sig, bot_val), anchor_val)
+
+    _, next_indices = _find_prev_and_next(is_anchor)
+    # The opening anchor of the first segment is the first sample
+    prev_anchor_indices = tr.cummax(tr.where(is_anchor, tr.arange(n, device=mod_sig.device).expand_as(mod_sig), 0),
+                                    dim=-1).values
+    prev_indices = tr.cat([tr.zeros_like(prev_anchor_indices[:, :1]), prev_anchor_indices[:, :-1]], dim=-1)
+    seg_ids = tr.cumsum(is_anchor.long(), dim=-1) - is_anchor.long()
+    seg_min = tr.full_like(mod_sig, float("inf"))
+    seg_min = seg_min.scatter_reduce(-1, seg_ids[:, 1:], mod_sig[:, 1:], reduce="amin", include_self=True)
+    seg_min = seg_min.gather(-1, seg_ids)
+
+    prev_target = anchor_val.gather(-1, prev_indices)
+    target = anchor_val.gather(-1, next_indices)
+    curr_range = tr.abs(mod_sig.gather(-1, prev_indices) - mod_sig.gather(-1, next_indices))
+    target_range = tr.abs(prev_target - target)
+    scale = target_range / curr_range
+    stretched = (mod_sig - seg_min) * scale
+    stretched_last = (mod_sig.gather(-1, next_indices) - seg_min) * scale
+    stretched = stretched + (target - stretched_last)
+
+    should_stretch = prev_target != target
+    should_stretch[:, 0] = False
+    stretched = tr.where(should_stretch, stretched, mod_sig)
     return stretched
 
 
@@ -295,18 +631,23 @@ def stretch_corners(mod_sig: T, max_n_corners: int = 10, smooth_n_frames: int =
     assert mod_sig.ndim == 2
     mod_sig = smoothen(mod_sig, smooth_n_frames)
     top_corners, bottom_corners = find_corners(mod_sig)
-    stretched_all = []
-    for m, t, b in zip(mod_sig, top_corners, bottom_corners):
-        n_corners = t.sum() + b.sum()
-        if n_corners > max_n_corners:
-            stretched = m
-        else:
-            stretched = _stretch_corners(m, t, b)
-        stretched_all.append(stretched)
-    stretched = tr.stack(stretched_all, dim=0)
+    n_corners = top_corners.sum(dim=-1, keepdim=True) + bottom_corners.sum(dim=-1, keepdim=True)
+    stretched = _stretch_corners(mod_sig, top_corners, bottom_corners)
+    stretched = tr.where(n_corners > max_n_corners, mod_sig, stretched)
     return stretched
 
 
+def _calc_min_corner_distance(corners: T) -> T:
+    # Returns n + 1 for rows with fewer than 2 corners
+    n = corners.size(-1)
+    is_corner = corners == 1
+    prev_indices, _ = _find_prev_and_next(is_corner)
+    prev_indices = tr.cat([tr.full_like(prev_indices[:, :1], -1), prev_indices[:, :-1]], dim=-1)
+    indices = tr.arange(n, device=corners.device).expand_as(prev_indices)
+    distances = tr.where(is_corner & (prev_indices >= 0), indices - prev_indices, tr.full_like(indices, n + 1))
+    return distances.min(dim=-1).values
+
+
 # TODO(cm): move params to config
 def check_mod_sig(mod_sig: T,
                   top_corners: T,
@@ -315,45 +656,38 @@ def check_mod_sig(mod_sig: T,
                   max_top_corners: int = 6,
                   min_bottom_corners: int = 1,
                   max_bottom_corners: int = 6,
-                  min_fraction_between_corners: float = 0.10) -> bool:
-    assert mod_sig.ndim == 1
+                  min_fraction_between_corners: float = 0.10) -> Union[bool, T]:
+    # Returns a bool for a single mod_sig and a bool mask for a batch of them
+    assert mod_sig.ndim in {1, 2}
     assert mod_sig.shape == top_corners.shape == bottom_corners.shape
-    n_top_corners = top_corners.sum()
-    n_bottom_corners = bottom_corners.sum()
-    if n_top_corners < min_top_corners:
-        return False
-    if n_bottom_corners < min_bottom_corners:
-        return False
-    if n_top_corners > max_top_corners:
-        return False
-    if n_bottom_corners > max_bottom_corners:
-        return False
-    n_frames = mod_sig.size(0)
+    if mod_sig.ndim == 1:
+        return check_mod_sig(mod_sig.unsqueeze(0),
+                             top_corners.unsqueeze(0),
+                             bottom_corners.unsqueeze(0),
+                             min_top_corners,
+                             max_top_corners,
+                             min_bottom_corners,
+                             max_bottom_corners,
+                             min_fraction_between_corners).item()
+    n_top_corners = top_corners.sum(dim=-1)
+    n_bottom_corners = bottom_corners.sum(dim=-1)
+    is_valid = (n_top_corners >= min_top_corners) & (n_top_corners <= max_top_corners)
+    is_valid &= (n_bottom_corners >= min_bottom_corners) & (n_bottom_corners <= max_bottom_corners)
+    n_frames = mod_sig.size(-1)
     min_n_frames = int(min_fraction_between_corners * n_frames)
-    top_indices = (top_corners == 1).nonzero(as_tuple=True)[0]
-    bottom_indices = (bottom_corners == 1).nonzero(as_tuple=True)[0]
-    if len(top_indices) > 1:
-        distances = [top_indices[idx + 1] - loc for idx, loc in enumerate(top_indices[:-1])]
-        if min(distances) < min_n_frames:
-            return False
-    if len(bottom_indices) > 1:
-        distances = [bottom_indices[idx + 1] - loc for idx, loc in enumerate(bottom_indices[:-1])]
-        if min(distances) < min_n_frames:
-            return False
-    return True
+    is_valid &= _calc_min_corner_distance(top_corners) >= min_n_frames
+    is_valid &= _calc_min_corner_distance(bottom_corners) >= min_n_frames
+    return is_valid
 
 
-def find_valid_mod_sig_indices(mod_sig: T) -> List[int]:
+def find_valid_mod_sig_mask(mod_sig: T) -> T:
     assert mod_sig.ndim == 2
     top_corners, bottom_corners = find_corners(mod_sig)
-    valid_indices = []
-    for idx in range(mod_sig.size(0)):
-        m = mod_sig[idx]
-        t = top_corners[idx]
-        b = bottom_corners[idx]
-        if check_mod_sig(m, t, b):
-            valid_indices.append(idx)
-    return valid_indices
+    return check_mod_sig(mod_sig, top_corners, bottom_corners)
+
+
+def find_valid_mod_sig_indices(mod_sig: T) -> List[int]:
+    return find_valid_mod_sig_mask(mod_sig).nonzero(as_tuple=True)[0].tolist()
 
 
 def smoothen(x: T, smooth_n_frames: int) -> T:
@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+import torch as tr
+import torchaudio
+from torch import Tensor as T
+from tqdm import tqdm
+
+from mod_extraction import audio_index
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(level=os.environ.get('LOGLEVEL', 'INFO'))
+
+PACKED_AUDIO_FILE_NAME = ".packed_audio.npy"
+PACKED_INDEX_FILE_NAME = ".packed_audio.json"
+
+
+def pack_audio_dir(input_dir: str, file_paths: List[str], dtype: str = "float16") -> None:
+    # Concatenates all files into a single 1D array, each file is stored channel major as (n_ch, n_frames)
+    assert dtype in {"float16", "float32"}
+    file_infos = audio_index.load_audio_index(input_dir, file_paths)
+    total_n_samples = sum(info.num_frames * info.num_channels for info in file_infos.values())
+    log.info(f"Packing {len(file_paths)} files ({total_n_samples} samples, {dtype}) in {input_dir}")
+
+    data_path = os.path.join(input_dir, PACKED_AUDIO_FILE_NAME)
+    data = np.lib.format.open_memmap(data_path, mode="w+", dtype=dtype, shape=(total_n_samples,))
+    files = {}
+    offset = 0
+    for file_path in tqdm(file_paths):
+        info = file_infos[file_path]
+        audio, _ = torchaudio.load(file_path)
+        assert audio.shape == (info.num_channels, info.num_frames)
+        n = audio.numel()
+        data[offset:offset + n] = audio.reshape(-1).numpy()
+        rel_path = os.path.relpath(os.path.abspath(file_path), os.path.abspath(input_dir))
+        files[rel_path] = [offset, info.num_frames, info.num_channels, info.mtime, info.size]
+        offset += n
+    data.flush()
+    del data
+
+    with open(os.path.join(input_dir, PACKED_INDEX_FILE_NAME), "w") as f:
+        json.dump({"dtype": dtype, "files": files}, f)
+
+
+class PackedAudio:
+    def __init__(self, input_dir: str) -> None:
+        self.input_dir = os.path.abspath(input_dir)
+        self.data_path = os.path.join(input_dir, PACKED_AUDIO_FILE_NAME)
+        index_path = os.path.join(input_dir, PACKED_INDEX_FILE_NAME)
+        assert os.path.isfile(self.data_path) and os.path.isfile(index_path), \
+            f"No packed audio found in {input_dir}, run scripts/pack_audio.py first"
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        self.dtype = index["dtype"]
+        self.files: Dict[str, List[Any]] = {os.path.join(self.input_dir, k): v for k, v in index["files"].items()}
+        # Opened lazily so that every DataLoader worker maps the file itself
+        self.data: Optional[np.ndarray] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+    def __contains__(self, file_path: str) -> bool:
+        return os.path.abspath(file_path) in self.files
+
+    def check_is_up_to_date(self, file_paths: List[str]) -> None:
+        for file_path in file_paths:
+            assert file_path in self, f"Missing from packed audio, repack {self.input_dir}: {file_path}"
+            _, _, _, mtime, size = self.files[os.path.abspath(file_path)]
+            info = audio_index.get_audio_file_info(file_path)
+            assert info.mtime == mtime and info.size == size, \
+                f"Modified since packing, repack {self.input_dir}: {file_path}"
+
+    def load(self, file_path: str, frame_offset: int = 0, num_frames: int = -1) -> T:
+        if self.data is None:
+            self.data = np.load(self.data_path, mmap_mode="r")
+        offset, file_n_frames, n_ch, _, _ = self.files[os.path.abspath(file_path)]
+        if num_frames < 0:
+            num_frames = file_n_frames - frame_offset
+        audio = self.data[offset:offset + (n_ch * file_n_frames)].reshape(n_ch, file_n_frames)
+        audio = audio[:, frame_offset:frame_offset + num_frames]
+        return tr.from_numpy(np.array(audio, dtype=np.float32))
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+from typing import Dict, Any, List
+
+import numpy as np
+import torch as tr
+import torchaudio
+from torch import Tensor as T
+from tqdm import tqdm
+
+from mod_extraction.fx_schema import make_fx_params
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(level=os.environ.get('LOGLEVEL', 'INFO'))
+
+SHARD_INDEX_FILE_NAME = "index.json"
+
+
+def make_record_dtype(n_ch: int, n_samples: int, mod_sig_n_samples: int) -> np.dtype:
+    # One fixed size record per example, so reading an example is a single contiguous read
+    return np.dtype([
+        ("dry", "<f4", (n_ch, n_samples)),
+        ("wet", "<f4", (n_ch, n_samples)),
+        ("mod_sig", "<f4", (mod_sig_n_samples,)),
+    ])
+
+
+def convert_preprocessed_dir(input_dir: str, output_dir: str, sr: float, shard_size: int = 1024) -> None:
+    # Converts the <md5>.pt, <md5>_dry.wav, <md5>_wet.wav layout of PreprocessedDataset into shards
+    assert shard_size > 0
+    pt_names = sorted(f for f in os.listdir(input_dir) if f.endswith(".pt") and not f.startswith("."))
+    assert len(pt_names) > 0
+    os.makedirs(output_dir, exist_ok=True)
+
+    record_dtype = None
+    n_ch, n_samples, mod_sig_n_samples = None, None, None
+    shard = None
+    shard_names = []
+    names = []
+    fx_params_columns = {}
+    for idx, pt_name in enumerate(tqdm(pt_names)):
+        name = pt_name[:-3]
+        data = tr.load(os.path.join(input_dir, pt_name))
+        dry, dry_sr = torchaudio.load(os.path.join(input_dir, f"{name}_dry.wav"))
+        wet, wet_sr = torchaudio.load(os.path.join(input_dir, f"{name}_wet.wav"))
+        assert dry_sr == sr and wet_sr == sr
+        mod_sig = data["mod_sig"]
+        if record_dtype is None:
+            n_ch, n_samples = dry.shape
+            mod_sig_n_samples = mod_sig.size(-1)
+            record_dtype = make_record_dtype(n_ch, n_samples, mod_sig_n_samples)
+        assert dry.shape == wet.shape == (n_ch, n_samples)
+        assert mod_sig.shape == (mod_sig_n_samples,)
+
+        record_idx = idx % shard_size
+        if record_idx == 0:
+            if shard is not None:
+                shard.flush()
+            shard_name = f"shard_{len(shard_names):05d}.npy"
+            shard_names.append(shard_name)
+            shard_n = min(shard_size, len(pt_names) - idx)
+            shard = np.lib.format.open_memmap(os.path.join(output_dir, shard_name),
+                                              mode="w+",
+                                              dtype=record_dtype,
+                                              shape=(shard_n,))
+        shard[record_idx] = (dry.numpy(), wet.numpy(), mod_sig.numpy())
+
+        names.append(name)
+        fx_params = data["fx_params"]
+        for k in fx_params_columns:
+            assert k in fx_params, f"Inconsistent fx_params keys in {pt_name}"
+        for k, v in fx_params.items():
+            if k not in fx_params_columns:
+                assert idx == 0, f"Inconsistent fx_params keys in {pt_name}"
+                fx_params_columns[k] = []
+            if isinstance(v, T):
+                v = v.item()
+            fx_params_columns[k].append(v)
+    shard.flush()
+    del shard
+
+    index = {
+        "sr": sr,
+        "n_ch": n_ch,
+        "n_samples": n_samples,
+        "mod_sig_n_samples": mod_sig_n_samples,
+        "shard_size": shard_size,
+        "n_examples": len(pt_names),
+        "shards": shard_names,
+        "names": names,
+        "fx_params": fx_params_columns,
+    }
+    with open(os.path.join(output_dir, SHARD_INDEX_FILE_NAME), "w") as f:
+        json.dump(index, f)
+    log.info(f"Wrote {len(pt_names)} examples to {len(shard_names)} shards in {output_dir}")
+
+
+class ShardReader:
+    def __init__(self, input_dir: str) -> None:
+        self.input_dir = input_dir
+        index_path = os.path.join(input_dir, SHARD_INDEX_FILE_NAME)
+        assert os.path.isfile(index_path), f"No shard index found in {input_dir}"
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        self.sr = index["sr"]
+        self.n_ch = index["n_ch"]
+        self.n_samples = index["n_samples"]
+        self.mod_sig_n_samples = index["mod_sig_n_samples"]
+        self.shard_size = index["shard_size"]
+        self.n_examples = index["n_examples"]
+        self.shard_names = index["shards"]
+        self.names = index["names"]
+        self.fx_params: Dict[str, List[Any]] = index["fx_params"]
+        # Shards are memory mapped lazily so that every DataLoader worker maps them itself
+        self.shards: Dict[int, np.ndarray] = {}
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["shards"] = {}
+        return state
+
+    def __len__(self) -> int:
+        return self.n_examples
+
+    def get_shard(self, shard_idx: int) -> np.ndarray:
+        shard = self.shards.get(shard_idx)
+        if shard is None:
+            shard = np.load(os.path.join(self.input_dir, self.shard_names[shard_idx]), mmap_mode="r")
+            self.shards[shard_idx] = shard
+        return shard
+
+    def read(self, idx: int) -> (T, T, T, Dict[str, Any]):
+        shard = self.get_shard(idx // self.shard_size)
+        record = np.array(shard[idx % self.shard_size])
+        dry = tr.from_numpy(record["dry"])
+        wet = tr.from_numpy(record["wet"])
+        mod_sig = tr.from_numpy(record["mod_sig"])
+        fx_params = make_fx_params(**{k: v[idx] for k, v in self.fx_params.items()})
+        return dry, wet, mod_sig, fx_params
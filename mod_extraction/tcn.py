@@ -3,6 +3,7 @@ import os
 from typing import Optional, List
 
 import torch as tr
+import torch.nn.functional as F
 from torch import Tensor
 from torch import nn
 
@@ -29,6 +30,37 @@ def causal_crop(x: Tensor, length: int) -> Tensor:
     return x
 
 
+LN_MODES = ["fixed", "any", "frame"]
+
+
+class LayerNormAnyLength(nn.Module):
+    """Layer norm without affine parameters that does not depend on the number of frames."""
+    def __init__(self, per_frame: bool = False, eps: float = 1e-5) -> None:
+        super().__init__()
+        self.per_frame = per_frame
+        self.eps = eps
+
+    def forward(self, x: Tensor) -> Tensor:
+        if self.per_frame:
+            # Normalizes over the second to last dim (channels or bins) of every frame separately
+            x = x.transpose(-1, -2)
+            x = F.layer_norm(x, x.shape[-1:], eps=self.eps)
+            return x.transpose(-1, -2)
+        # Same as nn.LayerNorm([dim_2, dim_1], elementwise_affine=False) for inputs of any length
+        return F.layer_norm(x, x.shape[-2:], eps=self.eps)
+
+
+def make_ln(ln_mode: str, n_ch: int, temporal_dim: Optional[int] = None) -> nn.Module:
+    # None of the modes have parameters or buffers, so state dicts are the same for all of them. Checkpoints trained with
+    # "fixed" can be loaded as "any" without conversion, which gives identical outputs at the trained length. "frame"
+    # normalizes differently and needs its own training.
+    assert ln_mode in LN_MODES
+    if ln_mode == "fixed":
+        assert temporal_dim is not None and temporal_dim > 0
+        return nn.LayerNorm([n_ch, temporal_dim], elementwise_affine=False)
+    return LayerNormAnyLength(per_frame=ln_mode == "frame")
+
+
 # TODO(cm): optimize for TorchScript
 class PaddingCached(nn.Module):
     """Cached padding for cached convolutions."""
@@ -115,7 +147,8 @@ class TCNBlock(nn.Module):
                  cond_dim: int = 0,
                  use_film_bn: bool = True,
                  is_causal: bool = True,
-                 is_cached: bool = False) -> None:
+                 is_cached: bool = False,
+                 ln_mode: str = "fixed") -> None:
         super().__init__()
         self.in_ch = in_ch
         self.out_ch = out_ch
@@ -130,6 +163,7 @@ class TCNBlock(nn.Module):
         self.use_film_bn = use_film_bn
         self.is_causal = is_causal
         self.is_cached = is_cached
+        self.ln_mode = ln_mode
         if is_causal:
             assert padding == 0, "If the TCN is causal, padding must be 0"
             self.crop_fn = causal_crop
@@ -148,8 +182,7 @@ class TCNBlock(nn.Module):
 
         self.ln = None
         if use_ln:
-            assert temporal_dim is not None and temporal_dim > 0
-            self.ln = nn.LayerNorm([in_ch, temporal_dim], elementwise_affine=False)
+            self.ln = make_ln(ln_mode, in_ch, temporal_dim)
 
         self.act = None
         if use_act:
@@ -180,7 +213,8 @@ class TCNBlock(nn.Module):
         x_in = x
         if self.ln is not None:
             assert x.size(1) == self.in_ch
-            assert x.size(2) == self.temporal_dim
+            if self.ln_mode == "fixed":
+                assert x.size(2) == self.temporal_dim
             x = self.ln(x)
         x = self.conv(x)
         if self.film is not None:
@@ -210,7 +244,8 @@ class TCN(nn.Module):
                  cond_dim: int = 0,
                  use_film_bn: bool = False,
                  is_causal: bool = True,
-                 is_cached: bool = False) -> None:
+                 is_cached: bool = False,
+                 ln_mode: str = "fixed") -> None:
         super().__init__()
         self.out_channels = out_channels
         self.in_ch = in_ch
@@ -225,6 +260,7 @@ class TCN(nn.Module):
         self.use_film_bn = use_film_bn
         self.is_causal = is_causal
         self.is_cached = is_cached
+        self.ln_mode = ln_mode
         if is_causal:
             assert padding == 0, "If the TCN is causal, padding must be 0"
             self.crop_fn = causal_crop
@@ -246,7 +282,7 @@ class TCN(nn.Module):
         assert len(strides) == self.n_blocks
         self.strides = strides
 
-        if use_ln:
+        if use_ln and ln_mode == "fixed":
             assert temporal_dims is not None
             assert len(temporal_dims) == self.n_blocks
 
@@ -277,7 +313,8 @@ class TCN(nn.Module):
                 cond_dim,
                 use_film_bn,
                 is_causal,
-                is_cached
+                is_cached,
+                ln_mode,
             ))
 
     def is_conditional(self) -> bool:
@@ -0,0 +1,23 @@
+import logging
+import os
+
+from mod_extraction.paths import DATA_DIR
+from mod_extraction.shards import convert_preprocessed_dir
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(level=os.environ.get('LOGLEVEL', 'INFO'))
+
+
+if __name__ == "__main__":
+    sr = 44100
+    shard_size = 1024
+    dataset_names = [
+        "idmt_4_fl_all_2",
+        "idmt_4_ch_all_2",
+    ]
+    for dataset_name in dataset_names:
+        for split in ["train", "val"]:
+            input_dir = os.path.join(DATA_DIR, dataset_name, split)
+            output_dir = os.path.join(DATA_DIR, f"{dataset_name}_sharded", split)
+            convert_preprocessed_dir(input_dir, output_dir, sr, shard_size)
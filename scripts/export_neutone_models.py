@@ -10,6 +10,7 @@ from neutone_sdk.utils import save_neutone_model
 from torch import Tensor
 
 from mod_extraction.models import LSTMEffectModel
+from mod_extraction.modulations import LFOWavetable, SHAPES
 from mod_extraction.paths import OUT_DIR, MODELS_DIR
 
 logging.basicConfig()
@@ -18,9 +19,16 @@ log.setLevel(level=os.environ.get("LOGLEVEL", "INFO"))
 
 
 class EffectModel(nn.Module):
-    def __init__(self, weights_path: Optional[str] = None, n_hidden: int = 64, sr: float = 44100) -> None:
+    def __init__(self,
+                 weights_path: Optional[str] = None,
+                 n_hidden: int = 64,
+                 sr: float = 44100,
+                 use_wavetable: bool = False) -> None:
         super().__init__()
         self.sr = sr
+        self.use_wavetable = use_wavetable
+        self.wavetable = LFOWavetable()
+        self.cos_shape_code = tr.tensor(SHAPES.index("cos"))
         self.model = LSTMEffectModel(in_ch=1, out_ch=1, n_hidden=n_hidden, latent_dim=1)
         if weights_path:
             assert os.path.isfile(weights_path)
@@ -42,7 +50,11 @@ class EffectModel(nn.Module):
         self.prev_phase = next_phase
         arg_r = arg_l + lfo_stereo_phase_offset.item()
         arg = tr.stack([arg_l, arg_r], dim=0)
-        lfo = (tr.cos(arg) + 1.0) / 2.0
+        if self.use_wavetable:
+            # The cos shape is (cos(arg + pi) + 1) / 2
+            lfo = self.wavetable(arg + tr.pi, self.cos_shape_code)
+        else:
+            lfo = (tr.cos(arg) + 1.0) / 2.0
         lfo *= lfo_depth
         lfo = lfo.unsqueeze(1)
         x = self.model(x, lfo)
@@ -0,0 +1,55 @@
+import logging
+import os
+
+import torch as tr
+import yaml
+
+from mod_extraction.inference import StreamingLFOExtractor
+from mod_extraction.models import Spectral2DCNN
+from mod_extraction.paths import MODELS_DIR, OUT_DIR, DATA_DIR
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(level=os.environ.get('LOGLEVEL', 'INFO'))
+
+
+if __name__ == "__main__":
+    model_name = "lfo_2dcnn_io_sa_25_25_no_ch_ln__ph_fl_ch_all_2__idmt_4__epoch_197_step_15840"
+    # (dry, wet) pairs for dry and wet ("io") models, only the wet path is used for wet only models
+    input_paths = [
+        (os.path.join(DATA_DIR, "songs/song_dry.wav"), os.path.join(DATA_DIR, "songs/song_wet.wav")),
+    ]
+    ch_idx = 0
+    n_samples = 88200
+    batch_size = 8
+
+    config_path = os.path.join(MODELS_DIR, f"{model_name}.yml")
+    weights_path = os.path.join(MODELS_DIR, f"{model_name}.pt")
+    with open(config_path, "r") as in_f:
+        config = yaml.safe_load(in_f)
+    model_config = config["model"]["init_args"]["model"]
+    assert model_config["class_path"].endswith(".Spectral2DCNN")
+    init_args = dict(model_config["init_args"])
+    init_args["n_samples"] = n_samples
+    # The layer norms have no parameters, so "any" loads the same weights and accepts chunks of any length
+    init_args["ln_mode"] = "any"
+    init_args["use_feature_cache"] = False
+    model = Spectral2DCNN(**init_args)
+
+    if not os.path.isfile(weights_path):
+        raise FileNotFoundError(f"Missing LFO model weights: {weights_path}, extract them from the checkpoint of "
+                                f"{model_name} with scripts/extract_model_weights.py first")
+    log.info(f"Loading LFO model weights: {weights_path}")
+    model.load_state_dict(tr.load(weights_path, map_location=tr.device("cpu")))
+    extractor = StreamingLFOExtractor(model, chunk_n_samples=n_samples, batch_size=batch_size)
+
+    save_dir = os.path.join(OUT_DIR, "extracted_lfos", model_name)
+    os.makedirs(save_dir, exist_ok=True)
+    for dry_path, wet_path in input_paths:
+        if extractor.in_ch == 2:
+            mod_sig_hat = extractor.extract_from_dry_wet_files(dry_path, wet_path, ch_idx=ch_idx)
+        else:
+            mod_sig_hat = extractor.extract_from_file(wet_path, ch_idx=ch_idx)
+        save_name = f"{os.path.splitext(os.path.basename(wet_path))[0]}.pt"
+        tr.save(mod_sig_hat, os.path.join(save_dir, save_name))
+        log.info(f"Extracted {mod_sig_hat.size(-1)} LFO frames from {wet_path}")
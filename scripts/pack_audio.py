@@ -0,0 +1,22 @@
+import logging
+import os
+
+from mod_extraction.datasets import RandomAudioChunkDataset
+from mod_extraction.packed_audio import pack_audio_dir
+from mod_extraction.paths import DATA_DIR
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(level=os.environ.get('LOGLEVEL', 'INFO'))
+
+
+if __name__ == "__main__":
+    ext = "wav"
+    dtype = "float16"
+    input_dirs = [
+        os.path.join(DATA_DIR, "idmt_4/train"),
+        os.path.join(DATA_DIR, "idmt_4/val"),
+    ]
+    for input_dir in input_dirs:
+        file_paths = RandomAudioChunkDataset.get_file_paths(input_dir, ext)
+        pack_audio_dir(input_dir, file_paths, dtype)
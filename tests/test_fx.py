@@ -0,0 +1,137 @@
+from typing import Dict
+
+import pytest
+import torch as tr
+from torch import Tensor as T
+
+from mod_extraction.fx import MonoFlangerChorusModule, apply_phaser, numba
+
+SR = 44100
+MAX_MIN_DELAY_MS = 5.0
+MAX_LFO_DELAY_MS = 5.0
+
+
+def make_flanger_inputs(batch_size: int,
+                        n_ch: int,
+                        n_samples: int,
+                        feedback: float,
+                        min_delay_width: float = 0.5,
+                        seed: int = 42) -> Dict[str, T]:
+    gen = tr.Generator().manual_seed(seed)
+    return {
+        "x": (tr.rand((batch_size, n_ch, n_samples), generator=gen) * 2.0) - 1.0,
+        "mod_sig": tr.rand((batch_size, n_samples), generator=gen),
+        "feedback": tr.full((batch_size,), feedback),
+        "min_delay_width": tr.full((batch_size,), min_delay_width),
+        "width": tr.rand((batch_size,), generator=gen),
+        "depth": tr.rand((batch_size,), generator=gen),
+        "mix": tr.rand((batch_size,), generator=gen),
+    }
+
+
+def make_flanger(batch_size: int, n_ch: int, n_samples: int, **kwargs) -> MonoFlangerChorusModule:
+    return MonoFlangerChorusModule(batch_size, n_ch, n_samples, SR, MAX_MIN_DELAY_MS, MAX_LFO_DELAY_MS, **kwargs)
+
+
+@pytest.mark.parametrize("feedback", [0.1, 0.7, 0.99])
+@pytest.mark.parametrize("min_delay_width", [0.0, 0.2, 1.0])  # Sets the block size of the chunked engine
+@pytest.mark.parametrize("batch_size, n_ch, n_samples", [(1, 1, 1000), (3, 2, 4410)])
+def test_chunked_engine_matches_loop(feedback: float,
+                                     min_delay_width: float,
+                                     batch_size: int,
+                                     n_ch: int,
+                                     n_samples: int) -> None:
+    inputs = make_flanger_inputs(batch_size, n_ch, n_samples, feedback, min_delay_width)
+    loop_out = make_flanger(batch_size, n_ch, n_samples, engine="loop")(**inputs)
+    chunked_out = make_flanger(batch_size, n_ch, n_samples, engine="chunked")(**inputs)
+    assert tr.allclose(loop_out, chunked_out, atol=1e-5)
+
+
+@pytest.mark.parametrize("engine", ["loop", "chunked"])
+def test_mixed_feedback_batch_matches_single_items(engine: str) -> None:
+    # Zero feedback items take the vectorized path and the others the recursive one, within the same batch
+    batch_size, n_ch, n_samples = 4, 2, 2000
+    inputs = make_flanger_inputs(batch_size, n_ch, n_samples, feedback=0.0)
+    inputs["feedback"] = tr.tensor([0.0, 0.5, 0.0, 0.9])
+    batch_out = make_flanger(batch_size, n_ch, n_samples, engine=engine)(**inputs)
+    flanger = make_flanger(1, n_ch, n_samples, engine=engine)
+    for idx in range(batch_size):
+        item_inputs = {k: v[idx:idx + 1] for k, v in inputs.items()}
+        item_out = flanger(**item_inputs)
+        assert tr.allclose(batch_out[idx:idx + 1], item_out, atol=1e-6)
+
+
+@pytest.mark.parametrize("backend", [
+    "torchscript",
+    pytest.param("numba", marks=pytest.mark.skipif(numba is None, reason="numba is not installed")),
+])
+@pytest.mark.parametrize("feedback", [0.1, 0.7, 0.99])
+@pytest.mark.parametrize("batch_size, n_ch, n_samples", [(1, 1, 1000), (3, 2, 4410)])
+def test_delay_loop_backend_matches_torch(backend: str,
+                                          feedback: float,
+                                          batch_size: int,
+                                          n_ch: int,
+                                          n_samples: int) -> None:
+    inputs = make_flanger_inputs(batch_size, n_ch, n_samples, feedback)
+    torch_out = make_flanger(batch_size, n_ch, n_samples, backend="torch")(**inputs)
+    backend_flanger = make_flanger(batch_size, n_ch, n_samples, backend=backend)
+    assert backend_flanger.backend == backend
+    backend_out = backend_flanger(**inputs)
+    assert tr.allclose(torch_out, backend_out, atol=1e-5)
+
+
+@pytest.mark.parametrize("engine", ["loop", "chunked"])
+@pytest.mark.parametrize("feedback", [0.0, 0.7])
+@pytest.mark.parametrize("block_n_samples", [1, 300, 512])
+def test_streaming_matches_full_render(engine: str, feedback: float, block_n_samples: int) -> None:
+    batch_size, n_ch, n_samples = 2, 2, 1200
+    inputs = make_flanger_inputs(batch_size, n_ch, n_samples, feedback)
+    full_out = make_flanger(batch_size, n_ch, n_samples, engine=engine)(**inputs)
+    streaming_flanger = make_flanger(batch_size, n_ch, block_n_samples, engine=engine, is_streaming=True)
+    streaming_out = []
+    for start_idx in range(0, n_samples, block_n_samples):
+        end_idx = start_idx + block_n_samples
+        block_inputs = dict(inputs)
+        block_inputs["x"] = inputs["x"][:, :, start_idx:end_idx]
+        block_inputs["mod_sig"] = inputs["mod_sig"][:, start_idx:end_idx]
+        streaming_out.append(streaming_flanger(**block_inputs))
+    streaming_out = tr.cat(streaming_out, dim=-1)
+    assert tr.allclose(full_out, streaming_out, atol=1e-5)
+
+
+# 0.0 and 0.7 are the feedback extremes of configs/data/gen_idmt_ph.yml, larger values are clamped by apply_phaser
+@pytest.mark.parametrize("backend", [
+    "torch",
+    "torchscript",
+    pytest.param("numba", marks=pytest.mark.skipif(numba is None, reason="numba is not installed")),
+])
+@pytest.mark.parametrize("feedback", [0.0, 0.7, 0.95, 1.0])
+def test_phaser_is_finite(backend: str, feedback: float) -> None:
+    batch_size, n_ch, n_samples = 3, 2, 4410
+    gen = tr.Generator().manual_seed(42)
+    x = (tr.rand((batch_size, n_ch, n_samples), generator=gen) * 2.0) - 1.0
+    # A white noise mod_sig modulates the cutoff frequencies as fast as possible
+    mod_sig = tr.rand((batch_size, n_samples), generator=gen)
+    out = apply_phaser(x, mod_sig, SR, 18000.0, 1.0, feedback, 1.0, backend=backend)
+    assert tr.isfinite(out).all()
+
+
+@pytest.mark.parametrize("backend", [
+    "torchscript",
+    pytest.param("numba", marks=pytest.mark.skipif(numba is None, reason="numba is not installed")),
+])
+@pytest.mark.parametrize("feedback", [0.0, 0.7, 0.95])
+@pytest.mark.parametrize("batch_size, n_ch, n_samples", [(1, 1, 1000), (3, 2, 4410)])
+def test_phaser_backend_matches_torch(backend: str,
+                                      feedback: float,
+                                      batch_size: int,
+                                      n_ch: int,
+                                      n_samples: int) -> None:
+    gen = tr.Generator().manual_seed(42)
+    x = (tr.rand((batch_size, n_ch, n_samples), generator=gen) * 2.0) - 1.0
+    mod_sig = tr.rand((batch_size, n_samples), generator=gen)
+    centre_frequency_hz = (tr.rand((batch_size,), generator=gen) * 2000.0) + 200.0
+    depth = tr.rand((batch_size,), generator=gen)
+    torch_out = apply_phaser(x, mod_sig, SR, centre_frequency_hz, depth, feedback, 1.0, backend="torch")
+    backend_out = apply_phaser(x, mod_sig, SR, centre_frequency_hz, depth, feedback, 1.0, backend=backend)
+    assert tr.allclose(torch_out, backend_out, atol=1e-4)